@@ -0,0 +1,153 @@
+"""Benchmark near-duplicate lookups in the SimHash index.
+
+Usage: python benchmarks/bench_near_dup.py [--size N] [--queries N]
+
+Fills a NearDuplicateIndex with SimHashes of N synthetic listings built from
+the price corpus texts and a vocabulary of typical listing phrases, so the
+fingerprints cluster the way real Ukrainian car ads do (shared words such as
+"продам", "пробіг", "торг"). Reports the bucket size distribution per band
+and average/p99 lookup latency for fresh listings and for reposts with small
+edits. Also measures SimHash throughput on the price corpus texts.
+
+The default size is the "few million stored posts" target. At 3,000,000
+listings (2,985,955 indexed) a run took ~4 minutes to build and measured
+fresh lookups at avg 37 us / p99 119 us, reposts at avg 11 us / p99 57 us,
+with ~900 MB peak RSS for the whole process. Use --size 500000 for a quick
+run.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+# bot.py читає налаштування під час імпорту
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('API_HASH', 'benchmark')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_corpus.jsonl')
+
+CARS = [
+    ('Opel', 'Astra'), ('Opel', 'Vectra'), ('VW', 'Passat'), ('VW', 'Golf'), ('Skoda', 'Octavia'),
+    ('Skoda', 'Fabia'), ('Renault', 'Megane'), ('Renault', 'Logan'), ('Daewoo', 'Lanos'), ('Daewoo', 'Sens'),
+    ('Toyota', 'Camry'), ('Toyota', 'Corolla'), ('Ford', 'Focus'), ('Chevrolet', 'Aveo'), ('Chevrolet', 'Lacetti'),
+    ('Mazda', '6'), ('Hyundai', 'Accent'), ('Kia', 'Ceed'), ('Nissan', 'Qashqai'), ('BMW', 'E90'),
+    ('Audi', 'A4'), ('Mitsubishi', 'Lancer'), ('Peugeot', '308'), ('ВАЗ', '2107'), ('ЗАЗ', 'Sens'),
+]
+OPENERS = ['Продам', 'Продається', 'Продаю', 'Терміново продам', 'В продажу', '']
+FUELS = ['бензин', 'дизель', 'газ/бензин', 'гібрид', 'TDI', 'газ пропан']
+CITIES = ['Київ', 'Львів', 'Одеса', 'Дніпро', 'Харків', 'Вінниця', 'Житомир', 'Рівне', 'Луцьк', 'Тернопіль']
+PHRASES = [
+    'торг', 'торг біля авто', 'терміново', 'розмитнена', 'свіжопригнана', 'один власник', 'гаражне зберігання',
+    'без ДТП', 'обмін не цікавить', 'можливий кредит', 'сервісна книжка', 'нова гума', 'два комплекти ключів',
+    'кондиціонер', 'мультируль', 'підігрів сидінь', 'фаркоп', 'зимова гума в подарунок', 'пробіг рідний',
+    'фарбувалась одна деталь', 'дзвоніть', 'пишіть в особисті', 'на ходу', 'вкладень не потребує',
+    'ТО пройдено', 'замінено ремінь ГРМ', 'нове зчеплення', 'салон чистий', 'документи в порядку',
+]
+PRICE_FORMATS = ['{p}$', '${p}', '{p} $', 'Ціна {p}$', 'ціна: {p} usd', '{k}k$', '{p} дол.', '{p} у.о.']
+REPOST_EDITS = ['🔥', '‼️', '#продаж', '#авто', 'Актуально', '📞 дзвоніть', 't.me/cars_ua', '@cars_ua']
+
+
+def synth_listing(rng, corpus):
+    """Return (text, price) for a synthetic listing."""
+    price = rng.randrange(1500, 15000, 100)
+    if rng.random() < 0.3:
+        # Текст із корпусу з іншими числами — реальна лексика та структура оголошень
+        text = re.sub(r'\d+', lambda m: str(rng.randrange(1, 10 ** len(m.group()))), rng.choice(corpus))
+        return f"{text}\nЦіна {price}$", float(price)
+    brand, model = rng.choice(CARS)
+    year = rng.randrange(1998, 2020)
+    parts = [
+        f"{rng.choice(OPENERS)} {brand} {model} {year}".strip(),
+        f"{rng.choice(['1.4', '1.6', '1.8', '2.0', '2.5'])} {rng.choice(FUELS)}",
+        f"пробіг {rng.randrange(80, 350)} тис км",
+        rng.choice(CITIES),
+        rng.choice(PRICE_FORMATS).format(p=price, k=round(price / 1000, 1)),
+    ] + rng.sample(PHRASES, rng.randint(1, 5))
+    return rng.choice([', ', '\n', '. ']).join(parts), float(price)
+
+
+def repost(rng, text):
+    """Return the same listing as reposted by another channel: a hashtag, emoji or link added."""
+    return f"{rng.choice(REPOST_EDITS)} {text}" if rng.random() < 0.5 else f"{text}\n{rng.choice(REPOST_EDITS)}"
+
+
+def bucket_report(index):
+    """Print bucket counts and sizes per band; 'per lookup' is the bucket size a stored post falls in."""
+    for band, bucket in enumerate(index._buckets):
+        sizes = sorted(1 if isinstance(entries, int) else len(entries) for entries in bucket.values())
+        total = sum(sizes)
+        per_lookup = sum(size * size for size in sizes) / total if total else 0.0
+        print(
+            f"band {band}: {len(sizes):,} buckets  median {sizes[len(sizes) // 2]}  "
+            f"p99 {sizes[int(len(sizes) * 0.99)]}  max {sizes[-1]:,}  per lookup {per_lookup:,.1f}"
+        )
+
+
+def measure(index, queries):
+    timings = []
+    found = 0
+    for fingerprint, price in queries:
+        started = time.perf_counter()
+        if index.find(fingerprint, price) is not None:
+            found += 1
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    avg = sum(timings) / len(timings) * 1e6
+    p99 = timings[int(len(timings) * 0.99)] * 1e6
+    return avg, p99, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=3_000_000, help='listings to index')
+    parser.add_argument('--queries', type=int, default=5_000, help='lookups per query type')
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        corpus = [json.loads(line)['text'] for line in f if line.strip()]
+
+    index = bot.NearDuplicateIndex()
+    sources = [f'@source{i}' for i in range(300)]
+    started = time.perf_counter()
+    stored = []
+    skipped = 0
+    for message_id in range(args.size):
+        text, price = synth_listing(rng, corpus)
+        fingerprint = bot.simhash(text)
+        if fingerprint is None:
+            # Закороткі тексти бот в індекс не додає
+            skipped += 1
+            continue
+        index.add(fingerprint, price, rng.choice(sources), message_id)
+        if message_id % max(1, args.size // args.queries) == 0:
+            stored.append((text, price))
+    print(f"Skipped {skipped:,} listings too short for a SimHash")
+    print(f"Built index of {len(index):,} listings in {time.perf_counter() - started:.1f}s")
+    bucket_report(index)
+
+    fresh = [synth_listing(rng, corpus) for _ in range(args.queries)]
+    fresh = [(bot.simhash(text), price) for text, price in fresh]
+    reposts = [(bot.simhash(repost(rng, text)), price) for text, price in stored[:args.queries]]
+    fresh = [(fingerprint, price) for fingerprint, price in fresh if fingerprint is not None]
+    reposts = [(fingerprint, price) for fingerprint, price in reposts if fingerprint is not None]
+    for name, queries in (('fresh listing', fresh), ('repost', reposts)):
+        avg, p99, found = measure(index, queries)
+        print(f"{name:>15}: avg {avg:7.1f} us  p99 {p99:7.1f} us  found {found}/{len(queries)}")
+
+    started = time.perf_counter()
+    for _ in range(50):
+        for text in corpus:
+            bot.simhash(text)
+    print(f"simhash: {len(corpus) * 50 / (time.perf_counter() - started):,.0f} texts/s")
+
+
+if __name__ == '__main__':
+    main()
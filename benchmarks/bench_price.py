@@ -0,0 +1,124 @@
+"""Benchmark the price extractor against the labelled listing corpus.
+
+Usage: python benchmarks/bench_price.py [--corpus FILE] [--repeat N]
+
+Reports messages/sec and precision/recall for the current `extract_price`
+and for the legacy four-pattern implementation it replaced, plus throughput
+on the messages without a price, where the cheap currency-marker check
+returns early.
+
+The default corpus is hand-written: listing texts modelled on typical
+Ukrainian car ads plus the edge cases found in review (year next to a
+price, "Euro 5", separators, suffixes, UAH/EUR). Rows were added alongside
+the fixes they cover, so it is a regression set and its scores are not an
+accuracy measure. For precision/recall on real traffic, export posts with
+benchmarks/sample_posts.py, label them by hand and pass the file with
+--corpus; rows with "labelled": false are skipped.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+# bot.py читає налаштування під час імпорту
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('API_HASH', 'benchmark')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_corpus.jsonl')
+
+
+def legacy_extract_price(text):
+    """The original extract_price, kept for comparison."""
+    if not text:
+        return None
+
+    patterns = [
+        r'\$\s*(\d+(?:,\d{3})*(?:\.\d{2})?)',
+        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*\$',
+        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*(?:USD|usd)',
+        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*(?:дол|dol)',
+    ]
+
+    for pattern in patterns:
+        match = re.search(pattern, text)
+        if match:
+            try:
+                return float(match.group(1).replace(',', ''))
+            except ValueError:
+                continue
+
+    return None
+
+
+def legacy_pipeline(text):
+    """Legacy path from check_historical_messages: marker pre-scan on a lowercased copy, then extraction."""
+    message_text = text.lower()
+    price_markers = ['$', 'usd', 'дол', 'dollar']
+    if any(marker in message_text for marker in price_markers):
+        return legacy_extract_price(message_text)
+    return None
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows = [row for row in rows if row.get('labelled', True)]
+    for row in rows:
+        row['expected_usd'] = bot.to_usd(row['price'], row['currency']) if row['price'] is not None else None
+    return rows
+
+
+def score(extractor, rows):
+    tp = fp = fn = 0
+    for row in rows:
+        got = extractor(row['text'])
+        expected = row['expected_usd']
+        correct = got is not None and expected is not None and abs(got - expected) <= expected * 0.01
+        if correct:
+            tp += 1
+        else:
+            if got is not None:
+                fp += 1
+            if expected is not None:
+                fn += 1
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return precision, recall
+
+
+def throughput(extractor, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            extractor(text)
+    elapsed = time.perf_counter() - start
+    return len(texts) * repeat / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default=CORPUS_PATH, help='labelled JSONL corpus')
+    parser.add_argument('--repeat', type=int, default=2000, help='passes over the corpus for the throughput run')
+    args = parser.parse_args()
+
+    rows = load_corpus(args.corpus)
+    texts = [row['text'] for row in rows]
+    priceless = [row['text'] for row in rows if row['price'] is None]
+    print(f"Corpus: {len(rows)} messages, {len(rows) - len(priceless)} with a price")
+    for name, extractor in (('legacy', legacy_pipeline), ('current', bot.extract_price)):
+        precision, recall = score(extractor, rows)
+        rate = throughput(extractor, texts, args.repeat)
+        line = f"{name:>8}: {rate:12,.0f} msg/s  precision={precision:.3f}  recall={recall:.3f}"
+        if priceless:
+            line += f"  no-price {throughput(extractor, priceless, args.repeat):,.0f} msg/s"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""Offline replay benchmark for the message handlers.
+
+Usage:
+    python benchmarks/replay.py --mode live --input stream.jsonl
+    python benchmarks/replay.py --mode gpt --synthesize 2000 --json
+    python benchmarks/replay.py --mode historical --synthesize 5000 --min-throughput 500
+
+Feeds a recorded JSONL stream of messages through the real handlers in
+bot.py with stand-ins for the outside world:
+
+- Telegram: a fake client replaces TelegramClient for both the user account
+  (events, iter_messages, get_entity) and the bot (send_message).
+- MongoDB: mongomock-motor (`pip install -r requirements-dev.txt`), or a real server
+  via --mongo-uri (use a throwaway database: the harness drops car_bot).
+- OpenAI: a local HTTP stub of the chat completions API, reached through
+  OPENAI_BASE_URL.
+
+Modes:
+    live        message_handler -> ingestion pipeline (set --live-gpt to
+                include the GPT tier)
+    gpt         handle_new_message, the GPT-backed handler
+    historical  run_backfill / check_historical_messages over every source
+
+Each input line is a JSON object:
+    {"chat_id": -1001, "username": "cars_ua", "id": 17, "text": "...",
+     "date": "2024-05-01T10:00:00", "grouped_id": null}
+
+Reports messages/sec, p50/p99 latency per message and API call counts.
+With --min-throughput the exit status is 1 when msg/s falls below it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+# bot.py читає налаштування під час імпорту: без реальних ключів, метрик і лімітів доставки
+os.environ.setdefault('BOT_TOKEN', 'replay')
+os.environ.setdefault('API_HASH', 'replay')
+os.environ.setdefault('OPENAI_API_KEY', 'replay')
+os.environ.setdefault('TARGET_CHAT_ID', '-100999')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('DELIVERY_GLOBAL_RATE', '1000000')
+os.environ.setdefault('DELIVERY_CHAT_RATE', '1000000')
+os.environ.setdefault('DELIVERY_GROUP_RATE', '1000000')
+os.environ.setdefault('POSTS_FLUSH_INTERVAL', '0.05')
+os.environ.setdefault('ANALYSIS_BATCH_WINDOW', '0.05')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logging  # noqa: E402
+
+import bot  # noqa: E402
+from openai import AsyncOpenAI  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_corpus.jsonl')
+
+
+class FakeMessage:
+    def __init__(self, record):
+        self.id = record['id']
+        self.text = record.get('text') or ''
+        self.date = datetime.fromisoformat(record['date']) if record.get('date') else datetime.utcnow()
+        self.grouped_id = record.get('grouped_id')
+
+
+class FakeChat:
+    def __init__(self, record):
+        self.id = record['chat_id']
+        self.username = record.get('username')
+
+
+class FakeEvent:
+    def __init__(self, record):
+        self.chat_id = record['chat_id']
+        self.message = FakeMessage(record)
+        self._chat = FakeChat(record)
+
+    async def get_chat(self):
+        return self._chat
+
+
+class FakeEntity:
+    def __init__(self, chat_id, username):
+        self.id = chat_id
+        self.username = username
+
+
+class FakeSession:
+    dc_id = 2
+
+
+class FakeTelegramClient:
+    """Stand-in for TelegramClient with the calls bot.py makes."""
+
+    def __init__(self, records, send_latency=0.0):
+        self.session = FakeSession()
+        self.send_latency = send_latency
+        self.handlers = []
+        self.sent = []
+        self.by_source = {}
+        self.chat_ids = {}
+        for record in records:
+            source = f"@{record['username']}"
+            self.by_source.setdefault(source, []).append(record)
+            self.chat_ids[source] = record['chat_id']
+        self.scan_latencies = []
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [(f, e) for f, e in self.handlers if f is not callback]
+        return 1
+
+    async def get_entity(self, entity):
+        if isinstance(entity, list):
+            return [await self.get_entity(item) for item in entity]
+        return FakeEntity(self.chat_ids[entity], entity.lstrip('@'))
+
+    async def iter_messages(self, source, min_id=None, offset_date=None, reverse=False):
+        if isinstance(source, FakeEntity):
+            source = f'@{source.username}'
+        records = sorted(self.by_source.get(source, []), key=lambda r: r['id'])
+        for record in records:
+            if min_id and record['id'] <= min_id:
+                continue
+            started = time.perf_counter()
+            yield FakeMessage(record)
+            # Час між видачею повідомлення й запитом наступного — обробка одного повідомлення
+            self.scan_latencies.append(time.perf_counter() - started)
+
+    async def send_message(self, chat_id, text):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append((chat_id, text))
+
+    async def disconnect(self):
+        pass
+
+
+class OpenAIStub:
+    """Minimal local HTTP server answering chat.completions requests."""
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.calls = 0
+        self.items = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{port}/v1'
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.decode('latin-1').split('\r\n'):
+                if line.lower().startswith('content-length:'):
+                    length = int(line.split(':', 1)[1])
+            body = json.loads(await reader.readexactly(length))
+            prompt = body['messages'][-1]['content']
+            count = max(1, prompt.count('Повідомлення '))
+            self.calls += 1
+            self.items += count
+            await asyncio.sleep(self.latency)
+            results = [dict(self._analyze(chunk), index=index)
+                       for index, chunk in enumerate(prompt.split('Повідомлення ')[1:count + 1], 1)]
+            content = json.dumps(results, ensure_ascii=False)
+            payload = json.dumps({
+                'id': f'stub-{self.calls}', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': body.get('model', 'stub'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            }).encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(payload) + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _analyze(text):
+        price = bot.extract_price(text)
+        return {
+            'is_car_sale': price is not None,
+            'price_usd': price,
+            'car_info': {'brand': 'Stub', 'model': 'Car', 'year': None, 'condition': 'used'},
+        }
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+
+def synthesize(count, sources=20, album_share=0.2):
+    """Build a synthetic stream from the price corpus, with reposts and albums."""
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        texts = [json.loads(line)['text'] for line in f if line.strip()]
+    rng = random.Random(42)
+    records = []
+    next_ids = {}
+    start = datetime.utcnow() - timedelta(hours=1)
+    while len(records) < count:
+        source = rng.randrange(sources)
+        chat_id = -1000000000000 - source
+        text = rng.choice(texts)
+        album = rng.random() < album_share
+        items = rng.randint(2, 6) if album else 1
+        grouped_id = rng.getrandbits(48) if album else None
+        for item in range(items):
+            next_ids[source] = next_ids.get(source, 0) + 1
+            records.append({
+                'chat_id': chat_id,
+                'username': f'source{source}',
+                'id': next_ids[source],
+                'text': text if item == 0 else '',
+                'date': (start + timedelta(seconds=len(records))).isoformat(),
+                'grouped_id': grouped_id,
+            })
+    return records[:count]
+
+
+def load_records(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def setup_mongo(uri):
+    if uri:
+        bot.MONGO_URI = uri
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        bot.AsyncIOMotorClient = AsyncMongoMockClient
+    await bot.init_mongodb()
+    await bot.mongo_client.drop_database('car_bot')
+    await bot.init_mongodb()
+
+
+async def replay_live(records, client, concurrency):
+    latencies = []
+    stages = bot.ingest_pipeline.stages
+
+    # Затримка повідомлення — від надходження до виходу з конвеєра (на будь-якому етапі)
+    def wrap(handler, last):
+        async def timed(item):
+            try:
+                result = await handler(item)
+            except Exception:
+                latencies.append(time.monotonic() - item['received_at'])
+                raise
+            if result is None or last:
+                latencies.append(time.monotonic() - item['received_at'])
+            return result
+        return timed
+
+    for index, stage in enumerate(stages[1:], 1):
+        stage.handler = wrap(stage.handler, index == len(stages) - 1)
+    bot.ingest_pipeline.start()
+    bot.register_message_handler()
+    handler = client.handlers[-1][0]
+
+    started = time.perf_counter()
+    for record in records:
+        await handler(FakeEvent(record))
+    await bot.album_coalescer.flush_all()
+    await bot.ingest_pipeline.drain(timeout=600)
+    await bot.live_watermarks.flush()
+    return time.perf_counter() - started, latencies
+
+
+async def replay_gpt(records, client, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(record):
+        async with semaphore:
+            started = time.perf_counter()
+            await bot.handle_new_message(FakeEvent(record))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    # Telethon запускає кожен обробник в окремій задачі, тож і тут вони конкурують
+    await asyncio.gather(*(handle(record) for record in records))
+    return time.perf_counter() - started, latencies
+
+
+async def replay_historical(records, client, concurrency):
+    started = time.perf_counter()
+    await bot.run_backfill(sorted(client.by_source), hours=72)
+    return time.perf_counter() - started, client.scan_latencies
+
+
+MODES = {'live': replay_live, 'gpt': replay_gpt, 'historical': replay_historical}
+
+
+async def run(args):
+    records = load_records(args.input) if args.input else synthesize(args.synthesize)
+    user_client = FakeTelegramClient(records)
+    bot_client = FakeTelegramClient([], send_latency=args.send_latency)
+    stub = OpenAIStub(latency=args.openai_latency)
+    base_url = await stub.start()
+    bot.openai_client = AsyncOpenAI(api_key='replay', base_url=base_url)
+    bot.LIVE_GPT_ANALYSIS = args.live_gpt
+
+    await setup_mongo(args.mongo_uri)
+    db = bot.mongo_client.car_bot
+    for source, source_records in user_client.by_source.items():
+        await db.sources.insert_one({'username': source, 'chat_id': source_records[0]['chat_id']})
+    await bot.source_registry.refresh()
+    await bot.subscription_index.load()
+
+    bot.user_client = user_client
+    bot.user_pool.clients = {bot.user_pool.primary: user_client}
+    bot.bot_client = bot_client
+    bot.delivery_queue.start()
+
+    try:
+        elapsed, latencies = await MODES[args.mode](records, user_client, args.concurrency)
+        await bot.post_writer.flush()
+        await bot.delivery_queue.drain(timeout=600)
+    finally:
+        stub.close()
+
+    report = {
+        'mode': args.mode,
+        'messages': len(records),
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(len(records) / elapsed, 1) if elapsed else None,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'openai_requests': stub.calls,
+        'openai_messages': stub.items,
+        'send_message_calls': len(bot_client.sent),
+        'posts_stored': await db.posts.count_documents({}),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=sorted(MODES), default='live')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--input', help='recorded JSONL message stream')
+    source.add_argument('--synthesize', type=int, default=1000, help='generate N messages from the price corpus')
+    parser.add_argument('--mongo-uri', help='use a real MongoDB instead of mongomock-motor')
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='seconds per stub OpenAI response')
+    parser.add_argument('--send-latency', type=float, default=0.0, help='seconds per fake send_message')
+    parser.add_argument('--concurrency', type=int, default=100, help='concurrent handler calls in gpt mode')
+    parser.add_argument('--live-gpt', action='store_true', help='enable the GPT tier in the live pipeline')
+    parser.add_argument('--json', action='store_true', help='print the report as one JSON line')
+    parser.add_argument('--min-throughput', type=float, help='exit 1 if messages/sec is below this')
+    parser.add_argument('--verbose', action='store_true', help='keep bot INFO logging')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>20}: {value}")
+    if args.min_throughput and (report['messages_per_sec'] or 0) < args.min_throughput:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Export recent channel messages for hand-labelling a price corpus of real posts.
+
+Usage: python benchmarks/sample_posts.py OUT.jsonl [--per-source N] [--sources @a,@b]
+
+Reads the last N messages of each source (from --sources, or the sources
+collection in MongoDB) through the first session in USER_SESSIONS and
+writes one JSON line per text message, priced or not:
+
+    {"text": "...", "source": "@cars_ua", "original_id": 17,
+     "price": null, "currency": null, "labelled": false}
+
+Fill in price and currency by hand (leave null when the message has no
+asking price) and set "labelled" to true, then score the extractor with
+`python benchmarks/bench_price.py --corpus OUT.jsonl`; unlabelled rows are
+skipped. Needs the bot's .env (API_ID, API_HASH, MONGO_URI). The texts can
+contain phone numbers and names, so keep sampled files out of the repository.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+
+async def monitored_sources():
+    client = bot.AsyncIOMotorClient(bot.MONGO_URI)
+    try:
+        return [doc['username'] async for doc in client.car_bot.sources.find({}, {'username': 1})]
+    finally:
+        client.close()
+
+
+async def sample(args):
+    sources = [s for s in args.sources.split(',') if s] if args.sources else await monitored_sources()
+    client = bot.TelegramClient(bot.USER_SESSIONS[0], bot.API_ID, bot.API_HASH)
+    await client.start()
+    written = 0
+    try:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for source in sources:
+                async for message in client.iter_messages(source, limit=args.per_source):
+                    if not message.text:
+                        continue
+                    row = {
+                        'text': message.text, 'source': bot.normalize_source(source), 'original_id': message.id,
+                        'price': None, 'currency': None, 'labelled': False,
+                    }
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                    written += 1
+    finally:
+        await client.disconnect()
+    print(f"Wrote {written} messages from {len(sources)} sources to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help='JSONL file to write')
+    parser.add_argument('--per-source', type=int, default=200, help='latest messages to read per source')
+    parser.add_argument('--sources', help='comma-separated sources instead of the sources collection')
+    asyncio.run(sample(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,25 @@ from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, errors
 from motor.motor_asyncio import AsyncIOMotorClient
 import json
 import asyncio
+import time
+import bisect
+import hashlib
+import itertools
+import random
+from array import array
+from collections import OrderedDict, deque
 from functools import partial
 from telethon.tl.functions.channels import JoinChannelRequest
-from openai import AsyncOpenAI
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+from openai import (AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError,
+                    RateLimitError)
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from telethon import utils as telethon_utils
 import re
 
 # Load environment variables
@@ -28,93 +40,1989 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 API_ID = int(os.getenv('API_ID', 0))
 API_HASH = os.getenv('API_HASH')
 
-# OpenAI client
-openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# OpenAI client (створюється при першому зверненні до GPT, а не під час старту)
+openai_client = None
+
+def get_openai_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global openai_client
+    if openai_client is None:
+        openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    return openai_client
 
 logger.info(f"Bot Token: {BOT_TOKEN[:10]}...")
 logger.info(f"API ID: {API_ID}")
 logger.info(f"API Hash: {API_HASH[:10]}...")
 
-# MongoDB connection
-MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
-logger.info(f"Connecting to MongoDB at: {MONGO_URI}")
+# MongoDB connection
+MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
+logger.info(f"Connecting to MongoDB at: {MONGO_URI}")
+
+# Global variables
+user_client = None  # Основний клієнт для читання повідомлень (перша сесія пулу)
+bot_client = None   # Клієнт для відправки повідомлень (бот)
+application = None
+mongo_client = None
+
+# Як часто перечитувати джерела, якщо change stream недоступний (секунди)
+SOURCES_REFRESH_INTERVAL = int(os.getenv('SOURCES_REFRESH_INTERVAL', 60))
+
+# Підписник за замовчуванням (TARGET_CHAT_ID) отримує оголошення до MAX_PRICE_USD
+TARGET_CHAT_ID = os.getenv('TARGET_CHAT_ID')
+# /subscribe зберігає ID чату числом — інакше той самий чат не впізнається серед підписників
+if TARGET_CHAT_ID and TARGET_CHAT_ID.lstrip('-').isdigit():
+    TARGET_CHAT_ID = int(TARGET_CHAT_ID)
+MAX_PRICE_USD = float(os.getenv('MAX_PRICE_USD', 10000))
+
+# Курси валют до USD для конвертації цін (можна перевизначити через FX_RATES='{"UAH": 0.024}')
+FX_RATES_TO_USD = {'USD': 1.0, 'EUR': 1.08, 'UAH': 0.024}
+FX_RATES_TO_USD.update(json.loads(os.getenv('FX_RATES', '{}')))
+# Менші суми не ціна авто: "1.6 Євро 5" — це об'єм і екоклас, а не 1.6 EUR
+MIN_PRICE_USD = float(os.getenv('MIN_PRICE_USD', 100))
+
+# Індекс фільтрів підписників: ширина цінового діапазону та верхня межа сітки (USD)
+SUBSCRIPTION_PRICE_BAND = float(os.getenv('SUBSCRIPTION_PRICE_BAND', 500))
+SUBSCRIPTION_PRICE_CAP = float(os.getenv('SUBSCRIPTION_PRICE_CAP', 100000))
+
+# Скільки джерел одночасно перевіряємо під час історичного сканування
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))
+BACKFILL_MAX_RETRIES = int(os.getenv('BACKFILL_MAX_RETRIES', 3))
+
+# Буферизований запис постів під час історичного сканування
+POSTS_BATCH_SIZE = int(os.getenv('POSTS_BATCH_SIZE', 500))
+POSTS_FLUSH_INTERVAL = float(os.getenv('POSTS_FLUSH_INTERVAL', 2.0))
+
+# Черга доставки: ліміти Bot API (~30 повідомлень/с загалом, 1/с в особистий чат, 20/хв у групу)
+DELIVERY_GLOBAL_RATE = float(os.getenv('DELIVERY_GLOBAL_RATE', 30))
+DELIVERY_CHAT_RATE = float(os.getenv('DELIVERY_CHAT_RATE', 1))
+DELIVERY_GROUP_RATE = float(os.getenv('DELIVERY_GROUP_RATE', 20 / 60))
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 4))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv('DELIVERY_MAX_ATTEMPTS', 5))
+
+# Кеш результатів GPT: розмір LRU у пам'яті та час життя записів у MongoDB
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', 10000))
+ANALYSIS_CACHE_TTL = int(os.getenv('ANALYSIS_CACHE_TTL', 7 * 24 * 3600))
+
+# Пакетний аналіз GPT: вікно збору, розмір пакета, паралельні запити, тайм-аут і повтори
+ANALYSIS_BATCH_WINDOW = float(os.getenv('ANALYSIS_BATCH_WINDOW', 0.5))
+ANALYSIS_BATCH_SIZE = int(os.getenv('ANALYSIS_BATCH_SIZE', 10))
+ANALYSIS_MAX_IN_FLIGHT = int(os.getenv('ANALYSIS_MAX_IN_FLIGHT', 3))
+ANALYSIS_TIMEOUT = float(os.getenv('ANALYSIS_TIMEOUT', 30))
+ANALYSIS_MAX_RETRIES = int(os.getenv('ANALYSIS_MAX_RETRIES', 4))
+ANALYSIS_BACKOFF_BASE = float(os.getenv('ANALYSIS_BACKOFF_BASE', 1.0))
+ANALYSIS_RETRY_BUDGET = float(os.getenv('ANALYSIS_RETRY_BUDGET', 60))
+
+# Конвеєр обробки live-повідомлень: розмір черг між етапами та кількість воркерів на етап
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 1000))
+PIPELINE_WORKERS = {
+    name: int(count)
+    for name, count in (pair.split('=') for pair in os.getenv('PIPELINE_WORKERS', '').split(',') if pair)
+}
+# Як часто записувати в MongoDB водяні знаки, які просунув live-конвеєр (секунди)
+WATERMARK_FLUSH_INTERVAL = float(os.getenv('WATERMARK_FLUSH_INTERVAL', 1.0))
+# Аналізувати live-повідомлення через GPT (з локальним префільтром) для car_info
+LIVE_GPT_ANALYSIS = os.getenv('LIVE_GPT_ANALYSIS', 'false').lower() == 'true'
+
+# Пошук майже однакових оголошень (SimHash): макс. відстань Хеммінга, допуск ціни, вікно завантаження
+NEAR_DUP_MAX_DISTANCE = int(os.getenv('NEAR_DUP_MAX_DISTANCE', 3))
+NEAR_DUP_PRICE_TOLERANCE = float(os.getenv('NEAR_DUP_PRICE_TOLERANCE', 0.02))
+NEAR_DUP_MIN_TOKENS = int(os.getenv('NEAR_DUP_MIN_TOKENS', 5))
+NEAR_DUP_WINDOW_DAYS = int(os.getenv('NEAR_DUP_WINDOW_DAYS', 30))
+# Скільки оголошень пам'ятати разом з їх отримувачами (щоб не читати БД для кожної копії)
+RECIPIENTS_CACHE_SIZE = int(os.getenv('RECIPIENTS_CACHE_SIZE', 50000))
+
+# Скільки чекати на решту фото альбому після останнього (секунди)
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', 1.0))
+
+# Локальний HTTP-ендпоінт з метриками у форматі Prometheus (0 — вимкнено)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+
+# Пошук по збережених оголошеннях: розмір сторінки та регістронезалежне порівняння марок/моделей
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 10))
+SEARCH_COLLATION = {'locale': 'uk', 'strength': 2}
+
+# Реєструвати обробник лише для ID моніторингових чатів (інші відкидає сам Telethon)
+HANDLER_CHAT_FILTER = os.getenv('HANDLER_CHAT_FILTER', 'true').lower() == 'true'
+# Як часто повторно визначати ID джерел, які не вдалося визначити раніше (секунди)
+SOURCE_RESOLVE_INTERVAL = int(os.getenv('SOURCE_RESOLVE_INTERVAL', 300))
+
+# Сесії акаунтів для читання джерел (через кому); джерела розподіляються між ними
+USER_SESSIONS = [name.strip() for name in os.getenv('USER_SESSIONS', 'user_session').split(',') if name.strip()]
+# Кількість віртуальних вузлів на сесію в кільці консистентного хешування
+SESSION_RING_REPLICAS = int(os.getenv('SESSION_RING_REPLICAS', 100))
+
+# Межі кошиків гістограм затримок (секунди)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus style."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # останній — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q-th quantile."""
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+class _StepTimer:
+    """Context manager behind Metrics.timed; a plain class is cheaper than @contextmanager on hot paths."""
+
+    __slots__ = ('metrics', 'step', 'started')
+
+    def __init__(self, metrics, step):
+        self.metrics = metrics
+        self.step = step
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.step, time.perf_counter() - self.started)
+        return False
+
+class Metrics:
+    """Per-step latency histograms and message counters."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._collectors = []
+
+    def observe(self, step, seconds):
+        histogram = self.histograms.get(step)
+        if histogram is None:
+            histogram = self.histograms[step] = Histogram()
+        histogram.observe(seconds)
+
+    def timed(self, step):
+        return _StepTimer(self, step)
+
+    def inc(self, outcome, value=1):
+        self.counters[outcome] = self.counters.get(outcome, 0) + value
+
+    def add_collector(self, name, stats, label=None):
+        """Export the numeric values of `stats()` as gauges named carbot_<name>_<key>.
+
+        Nested dicts (e.g. per pipeline stage) become a `label` on each gauge.
+        """
+        self._collectors.append((name, stats, label))
+
+    @staticmethod
+    def _collector_lines(name, values, label):
+        lines = []
+        for key, value in values.items():
+            if _is_number(value):
+                lines.append(f'carbot_{name}_{key} {value}')
+            elif isinstance(value, dict):
+                for label_value, nested in value.items():
+                    if _is_number(nested):
+                        lines.append(f'carbot_{name}_{key}{{{label}="{label_value}"}} {nested}')
+                    elif isinstance(nested, dict):
+                        for nested_key, nested_value in nested.items():
+                            if _is_number(nested_value):
+                                lines.append(f'carbot_{name}_{nested_key}{{{label}="{label_value}"}} {nested_value}')
+        return lines
+
+    def render_prometheus(self):
+        lines = [
+            '# HELP carbot_step_latency_seconds Latency of processing steps.',
+            '# TYPE carbot_step_latency_seconds histogram',
+        ]
+        for step, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'carbot_step_latency_seconds_bucket{{step="{step}",le="{le}"}} {cumulative}')
+            lines.append(f'carbot_step_latency_seconds_sum{{step="{step}"}} {histogram.sum}')
+            lines.append(f'carbot_step_latency_seconds_count{{step="{step}"}} {histogram.count}')
+        lines += [
+            '# HELP carbot_messages_total Messages by outcome.',
+            '# TYPE carbot_messages_total counter',
+        ]
+        for outcome, value in sorted(self.counters.items()):
+            lines.append(f'carbot_messages_total{{outcome="{outcome}"}} {value}')
+        for name, stats, label in self._collectors:
+            try:
+                lines += self._collector_lines(name, stats(), label or 'key')
+            except Exception as e:
+                logger.error(f"Error collecting {name} metrics: {e}")
+        return '\n'.join(lines) + '\n'
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+metrics = Metrics()
+
+async def _serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Решту заголовків читаємо й ігноруємо
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', metrics.render_prometheus().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """Start the Prometheus metrics endpoint, or return None if it is disabled or cannot bind."""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        # Порт може бути зайнятий, наприклад, другим екземпляром — бот працює і без /metrics
+        logger.error(f"Metrics endpoint disabled, cannot listen on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return None
+    logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+class StartupTimer:
+    """Wall-clock timings of startup phases and the time to the first processed message."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.first_message = None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    async def phase(self, name, awaitable):
+        """Await one startup phase and record how long it took."""
+        started = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.phases[name] = round(time.monotonic() - started, 3)
+            logger.info(f"Startup phase {name} took {self.phases[name]:.2f}s")
+
+    def mark_first_message(self):
+        if self.first_message is None:
+            self.first_message = round(time.monotonic() - self.started, 3)
+            logger.info(f"First message processed {self.first_message:.2f}s after startup")
+
+    def stats(self):
+        return {
+            'phases': dict(self.phases),
+            'uptime_seconds': round(time.monotonic() - self.started, 1),
+            'first_message_seconds': self.first_message,
+        }
+
+startup_timer = StartupTimer()
+metrics.add_collector('startup', startup_timer.stats, label='phase')
+
+# Які зміни джерел перечитувати: запис водяного знака (last_message_id) чи сесії не змінює реєстр,
+# а без фільтра кожен live-запис викликав би повне перечитування джерел
+SOURCES_CHANGE_PIPELINE = [{'$match': {'$or': [
+    {'operationType': {'$in': ['insert', 'delete', 'replace', 'drop', 'rename', 'dropDatabase', 'invalidate']}},
+    {'operationType': 'update', 'updateDescription.updatedFields.username': {'$exists': True}},
+    {'operationType': 'update', 'updateDescription.updatedFields.chat_id': {'$exists': True}},
+]}}]
+
+class SourceRegistry:
+    """Process-wide in-memory set of monitored sources keyed by username and chat ID."""
+
+    def __init__(self):
+        self.usernames = set()
+        self.chat_ids = {}  # marked chat ID -> username
+        self.watermarks = {}  # username -> ID останнього обробленого повідомлення
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.change_events = 0
+        self.last_refresh = None
+        self._listeners = []
+        self._notified_ids = frozenset()
+
+    def subscribe(self, callback):
+        """Call `callback()` whenever the set of resolved chat IDs changes."""
+        self._listeners.append(callback)
+
+    def _changed(self):
+        chat_ids = frozenset(self.chat_ids)
+        if chat_ids == self._notified_ids:
+            return
+        self._notified_ids = chat_ids
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in source registry listener: {e}")
+
+    def load(self, docs):
+        """Replace the registry contents with the given source documents."""
+        usernames = set()
+        chat_ids = {}
+        watermarks = {}
+        for doc in docs:
+            usernames.add(doc['username'])
+            if doc.get('chat_id') is not None:
+                chat_ids[doc['chat_id']] = doc['username']
+            # Не відкочуємо водяний знак, якщо в пам'яті він уже новіший
+            watermark = max(doc.get('last_message_id') or 0, self.watermarks.get(doc['username'], 0))
+            if watermark:
+                watermarks[doc['username']] = watermark
+        self.usernames = usernames
+        self.chat_ids = chat_ids
+        self.watermarks = watermarks
+        self.refreshes += 1
+        self.last_refresh = datetime.utcnow()
+        self._changed()
+
+    def add(self, username, chat_id=None):
+        self.usernames.add(username)
+        if chat_id is not None:
+            self.chat_ids[chat_id] = username
+        self._changed()
+
+    def remove(self, username):
+        self.usernames.discard(username)
+        self.chat_ids = {k: v for k, v in self.chat_ids.items() if v != username}
+        self.watermarks.pop(username, None)
+        self._changed()
+
+    def unresolved(self):
+        """Return usernames that have no known chat ID yet."""
+        return sorted(self.usernames - set(self.chat_ids.values()))
+
+    def match(self, username=None, chat_id=None):
+        """Return the monitored source username for a chat, or None."""
+        source = self.chat_ids.get(chat_id) if chat_id is not None else None
+        if source is None and username in self.usernames:
+            source = username
+        if source is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return source
+
+    def list(self):
+        return sorted(self.usernames)
+
+    async def advance_watermark(self, username, message_id):
+        """Move a source's high-water mark forward in memory and in MongoDB."""
+        if message_id <= self.watermarks.get(username, 0):
+            return
+        self.watermarks[username] = message_id
+        try:
+            db = mongo_client.car_bot
+            await db.sources.update_one({'username': username}, {'$max': {'last_message_id': message_id}})
+        except Exception as e:
+            logger.error(f"Error saving watermark for {username}: {e}")
+
+    def stats(self):
+        return {
+            'sources': len(self.usernames),
+            'resolved_chat_ids': len(self.chat_ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'change_events': self.change_events,
+            'last_refresh': self.last_refresh,
+        }
+
+    async def refresh(self):
+        """Reload all sources from MongoDB."""
+        try:
+            db = mongo_client.car_bot
+            docs = await db.sources.find({}, {'username': 1, 'chat_id': 1, 'last_message_id': 1}).to_list(length=None)
+            self.load(docs)
+            logger.info(f"Source registry refreshed: {len(self.usernames)} sources")
+        except Exception as e:
+            logger.error(f"Error refreshing source registry: {e}")
+
+    async def watch(self):
+        """Keep the registry in sync via a change stream, falling back to polling."""
+        db = mongo_client.car_bot
+        try:
+            async with db.sources.watch(SOURCES_CHANGE_PIPELINE) as stream:
+                logger.info("Watching sources collection via change stream")
+                async for change in stream:
+                    self.change_events += 1
+                    await self.refresh()
+                    await resolve_source_ids()
+        except OperationFailure as e:
+            # Change streams працюють лише на replica set, тому опитуємо БД
+            logger.warning(f"Change stream unavailable ({e}), polling sources every {SOURCES_REFRESH_INTERVAL}s")
+        except Exception as e:
+            logger.error(f"Source change stream failed: {e}")
+        while True:
+            await asyncio.sleep(SOURCES_REFRESH_INTERVAL)
+            await self.refresh()
+            await resolve_source_ids()
+
+source_registry = SourceRegistry()
+metrics.add_collector('sources', source_registry.stats)
+
+class UserSessionPool:
+    """Pool of user-account clients with sources sharded by consistent hashing.
+
+    Each session owns the sources that hash to it on the ring and is the only
+    one that listens to, backfills and resolves them. Adding or removing a
+    session moves only the sources on its arcs of the ring. The ring holds
+    only the sessions that actually connected, so a session that fails to
+    start hands its sources to the others instead of leaving them unread.
+    """
+
+    def __init__(self, names, replicas=SESSION_RING_REPLICAS):
+        self.configured = list(names)
+        self.names = list(names)  # сесії в кільці: після start() — лише підключені
+        self.replicas = replicas
+        self.clients = {}  # session name -> TelegramClient
+        self.handlers = {}  # session name -> bound message handler
+        self.moves = 0
+        self._build_ring()
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def _build_ring(self):
+        points = sorted(
+            (self._hash(f"{name}#{replica}"), name)
+            for name in self.names for replica in range(self.replicas)
+        )
+        self._ring_keys = [point for point, _ in points]
+        self._ring_names = [name for _, name in points]
+
+    @property
+    def primary(self):
+        """The first configured session: it read every source before sharding."""
+        return self.configured[0] if self.configured else None
+
+    def owner(self, source):
+        """Return the session name that owns a source."""
+        if not self._ring_keys:
+            return None
+        position = bisect.bisect(self._ring_keys, self._hash(normalize_source(source)))
+        return self._ring_names[position % len(self._ring_keys)]
+
+    def session_for(self, source):
+        """Return (session name, client) that reads a source: its owner, or a connected fallback."""
+        name = self.owner(source)
+        if name not in self.clients and self.clients:
+            name = self.primary if self.primary in self.clients else next(iter(self.clients))
+        return name, self.clients.get(name)
+
+    def client_for(self, source):
+        """Return the connected client that reads a source."""
+        return self.session_for(source)[1]
+
+    def shard(self, sources):
+        """Group sources by owning session."""
+        shards = {name: [] for name in self.names}
+        for source in sources:
+            shards.setdefault(self.owner(source), []).append(source)
+        return shards
+
+    async def start(self):
+        """Connect every configured session concurrently."""
+        async def start_session(name):
+            client = TelegramClient(name, API_ID, API_HASH)
+            await client.start()
+            logger.info(f"User session {name} started")
+            return name, client
+        
+        pending = [name for name in self.configured if name not in self.clients]
+        results = await asyncio.gather(*(start_session(name) for name in pending), return_exceptions=True)
+        for name, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to start user session {name}, its sources go to the other sessions: {result}")
+                continue
+            self.clients[name] = result[1]
+        if not self.clients:
+            raise RuntimeError('No user sessions could be started')
+        self.names = [name for name in self.configured if name in self.clients]
+        self._build_ring()
+
+    def register_handlers(self):
+        """(Re)register the message handler on each session for the chats it owns."""
+        shards = self.shard(source_registry.chat_ids.values())
+        chat_ids_by_source = {source: chat_id for chat_id, source in source_registry.chat_ids.items()}
+        for name, client in self.clients.items():
+            client.remove_event_handler(self.handlers.pop(name, message_handler))
+            if HANDLER_CHAT_FILTER:
+                chat_ids = [chat_ids_by_source[source] for source in shards.get(name, [])]
+                self.handlers[name] = message_handler
+                client.add_event_handler(message_handler, events.NewMessage(chats=chat_ids))
+                logger.info(f"Session {name}: message handler bound to {len(chat_ids)} monitored chats")
+            else:
+                # Сесія досі в каналах, які читала до шардингу — обробник відкидає чужі джерела
+                self.handlers[name] = partial(message_handler, session=name)
+                client.add_event_handler(self.handlers[name], events.NewMessage())
+                logger.info(f"Session {name}: message handler registered for all chats")
+
+    async def rebalance(self):
+        """Store each source's owning session and join channels that moved to a new session."""
+        db = mongo_client.car_bot
+        moved = []
+        try:
+            async for doc in db.sources.find({}, {'username': 1, 'session': 1}):
+                owner = self.owner(doc['username'])
+                # Джерела без поля session читала основна сесія
+                previous = doc.get('session') or self.primary
+                if doc.get('session') != owner:
+                    await db.sources.update_one({'_id': doc['_id']}, {'$set': {'session': owner}})
+                if previous != owner:
+                    moved.append((doc['username'], owner))
+        except Exception as e:
+            logger.error(f"Error rebalancing sources across sessions: {e}")
+            return
+        
+        for source, owner in moved:
+            client = self.clients.get(owner)
+            if client is not None:
+                await join_channels(client, [source])
+        self.moves += len(moved)
+        logger.info(f"Sources assigned across sessions {self.names}, {len(moved)} moved")
+
+    async def disconnect(self):
+        for client in self.clients.values():
+            await client.disconnect()
+
+    def stats(self):
+        shards = self.shard(source_registry.usernames)
+        return {
+            'sessions': {
+                name: {'connected': int(name in self.clients), 'sources': len(shards.get(name, []))}
+                for name in self.configured
+            },
+            'moves': self.moves,
+        }
+
+user_pool = UserSessionPool(USER_SESSIONS)
+metrics.add_collector('user_sessions', user_pool.stats, label='session')
+
+class EntityCache:
+    """Persisted username -> peer ID/access hash cache for each user session.
+
+    Access hashes are issued per account, so entries are keyed by session.
+    A cached entry lets Telethon build the input peer locally instead of
+    calling ResolveUsername, which is slow and heavily rate-limited.
+    """
+
+    def __init__(self):
+        self.entries = {}  # (session, '@username') -> cache document
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        """Load all cached entities from MongoDB."""
+        try:
+            docs = await mongo_client.car_bot.entities.find({}, {'_id': 0}).to_list(length=None)
+            self.entries = {(doc['session'], doc['username']): doc for doc in docs}
+            logger.info(f"Loaded {len(self.entries)} cached entities")
+        except Exception as e:
+            logger.error(f"Error loading entity cache: {e}")
+
+    def get(self, session, username):
+        """Return a cached input peer, or None."""
+        doc = self.entries.get((session, normalize_source(username)))
+        if doc is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if doc['kind'] == 'channel':
+            return InputPeerChannel(doc['id'], doc['access_hash'])
+        if doc['kind'] == 'user':
+            return InputPeerUser(doc['id'], doc['access_hash'])
+        return InputPeerChat(doc['id'])
+
+    async def store(self, session, username, entity):
+        """Remember a resolved entity in memory and in MongoDB."""
+        try:
+            input_peer = telethon_utils.get_input_peer(entity)
+        except TypeError:
+            return
+        if isinstance(input_peer, InputPeerChannel):
+            kind, peer, access_hash = 'channel', input_peer.channel_id, input_peer.access_hash
+        elif isinstance(input_peer, InputPeerUser):
+            kind, peer, access_hash = 'user', input_peer.user_id, input_peer.access_hash
+        elif isinstance(input_peer, InputPeerChat):
+            kind, peer, access_hash = 'chat', input_peer.chat_id, None
+        else:
+            return
+        
+        key = (session, normalize_source(username))
+        doc = {
+            'session': session,
+            'username': key[1],
+            'kind': kind,
+            'id': peer,
+            'access_hash': access_hash,
+            'peer_id': telethon_utils.get_peer_id(input_peer),
+        }
+        cached = self.entries.get(key)
+        if cached is not None and all(cached.get(field) == value for field, value in doc.items()):
+            return
+        self.entries[key] = doc
+        try:
+            await mongo_client.car_bot.entities.update_one(
+                {'session': session, 'username': key[1]},
+                {'$set': dict(doc, updated_at=datetime.utcnow())}, upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error saving entity {username} to cache: {e}")
+
+    def discard(self, session, username):
+        self.entries.pop((session, normalize_source(username)), None)
+
+    async def resolve(self, source):
+        """Return an input peer for a source from the cache, or resolve it via its session."""
+        # Access hash дійсний лише для акаунта, що його отримав — ключ за фактичною сесією
+        session, client = user_pool.session_for(source)
+        peer = self.get(session, source)
+        if peer is not None:
+            return peer
+        entity = await client.get_entity(source)
+        await self.store(session, source, entity)
+        return entity
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+entity_cache = EntityCache()
+metrics.add_collector('entity_cache', entity_cache.stats)
+
+async def _ensure_posts_unique_index():
+    try:
+        await mongo_client.car_bot.posts.create_index(
+            [('source', 1), ('original_id', 1)], unique=True, name='source_original_id_unique'
+        )
+    except OperationFailure as e:
+        if e.code == 11000:
+            raise DuplicateKeyError(str(e), e.code, e.details)
+        raise
+
+async def remove_duplicate_posts():
+    """Delete all but the earliest copy of each (source, original_id) pair. Returns the count removed."""
+    posts = mongo_client.car_bot.posts
+    pipeline = [
+        {'$sort': {'_id': 1}},
+        {'$group': {'_id': {'source': '$source', 'original_id': '$original_id'}, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    removed = 0
+    async for group in posts.aggregate(pipeline, allowDiskUse=True):
+        result = await posts.delete_many({'_id': {'$in': group['ids'][1:]}})
+        removed += result.deleted_count
+    return removed
+
+async def migrate_post_sources():
+    """Rewrite posts.source values stored before normalize_source to the canonical key.
+
+    Returns the number of posts updated. A post already stored under both
+    spellings keeps only its canonical copy.
+    """
+    posts = mongo_client.car_bot.posts
+    updated = 0
+    for source in await posts.distinct('source'):
+        canonical = normalize_source(source)
+        if canonical == source:
+            continue
+        # Копію під новим ключем уже записано — стару прибираємо, інакше перейменування впреться в індекс
+        original_ids = await posts.distinct('original_id', {'source': source})
+        taken = await posts.distinct('original_id', {'source': canonical, 'original_id': {'$in': original_ids}})
+        if taken:
+            await posts.delete_many({'source': source, 'original_id': {'$in': taken}})
+        result = await posts.update_many({'source': source}, {'$set': {'source': canonical}})
+        updated += result.modified_count
+        logger.info(f"Migrated {result.modified_count} posts from source {source!r} to {canonical}")
+    return updated
+
+async def init_mongodb():
+    global mongo_client
+    try:
+        mongo_client = AsyncIOMotorClient(MONGO_URI)
+        await mongo_client.admin.command('ping')
+        logger.info("Successfully connected to MongoDB and verified connection")
+    except Exception as e:
+        logger.error(f"Failed to connect to MongoDB: {e}")
+        raise
+    
+    # Старі пости записані під '@' + ім'я як є: без міграції backfill знову вставив і переслав би їх
+    await migrate_post_sources()
+    
+    # Унікальний індекс робить дедуплікацію однією вставкою без find_one.
+    # Без нього save_post пропускає все, тож старт без індексу неприпустимий
+    try:
+        await _ensure_posts_unique_index()
+    except DuplicateKeyError as e:
+        logger.warning(f"Existing duplicate posts block the unique index ({e}), removing them")
+        removed = await remove_duplicate_posts()
+        logger.info(f"Removed {removed} duplicate posts")
+        await _ensure_posts_unique_index()
+    logger.info("Ensured unique index on posts (source, original_id)")
+    
+    try:
+        await mongo_client.car_bot.analysis_cache.create_index(
+            'created_at', expireAfterSeconds=ANALYSIS_CACHE_TTL, name='created_at_ttl'
+        )
+    except Exception as e:
+        logger.error(f"Failed to create TTL index on analysis_cache: {e}")
+    
+    try:
+        # Індекси для /search: рівність (марка, модель) → сортування (дата) → діапазони (ціна, рік)
+        await mongo_client.car_bot.posts.create_index(
+            [('car_info.brand', 1), ('car_info.model', 1), ('message_date', -1), ('price', 1), ('car_info.year', 1)],
+            name='search_brand_model', collation=SEARCH_COLLATION
+        )
+        # Лише марка (/search opel * 6000 2008): без моделі попередній індекс не дає сортування за датою
+        await mongo_client.car_bot.posts.create_index(
+            [('car_info.brand', 1), ('message_date', -1), ('price', 1), ('car_info.year', 1)],
+            name='search_brand_date', collation=SEARCH_COLLATION
+        )
+        await mongo_client.car_bot.posts.create_index(
+            [('message_date', -1), ('price', 1), ('car_info.year', 1)],
+            name='search_date_price', collation=SEARCH_COLLATION
+        )
+        logger.info("Ensured search indexes on posts")
+    except Exception as e:
+        logger.error(f"Failed to create search indexes on posts: {e}")
+    
+    try:
+        # NearDuplicateIndex.load читає пости з SimHash за останні дні — без індексу це повний скан
+        await mongo_client.car_bot.posts.create_index(
+            'posted_at', name='near_dup_posted_at', partialFilterExpression={'simhash': {'$exists': True}}
+        )
+    except Exception as e:
+        logger.error(f"Failed to create near-duplicate index on posts: {e}")
+    
+    try:
+        await mongo_client.car_bot.entities.create_index(
+            [('session', 1), ('username', 1)], unique=True, name='session_username_unique'
+        )
+    except Exception as e:
+        logger.error(f"Failed to create index on entities: {e}")
+    return mongo_client
+
+def normalize_source(source):
+    """Return the canonical posts key for a source: '@username' in lower case or the numeric chat ID."""
+    source = str(source).strip()
+    if source.lstrip('-').isdigit():
+        return source
+    return '@' + source.lstrip('@').lower()
+
+async def save_post(post_data):
+    """Insert a post unless it was already seen. Returns True if the post is new."""
+    post_data['source'] = normalize_source(post_data['source'])
+    try:
+        with metrics.timed('mongo_insert_post'):
+            await mongo_client.car_bot.posts.insert_one(post_data)
+        return True
+    except DuplicateKeyError:
+        return False
+
+_SIMHASH_MASK = (1 << 64) - 1
+# Біт ознаки -> 16-бітний лічильник: 64 лічильники в одному цілому додаються за одну операцію
+_SIMHASH_SPREAD = [
+    bytes(byte >> bit & 1 if half == 0 else 0 for bit in range(8) for half in range(2)) for byte in range(256)
+]
+_SIMHASH_ONES = int.from_bytes(b'\x01\x00' * 64, 'little')
+_SIMHASH_HIGH_BIT = bytes.maketrans(bytes(range(256)), b'0' * 128 + b'1' * 128)
+# Слова та пари слів в оголошеннях повторюються, тож лічильники ознак кешуємо
+_SIMHASH_CACHE_SIZE = 50000
+_simhash_features = {}
+
+def _feature_counts(feature):
+    counts = _simhash_features.get(feature)
+    if counts is None:
+        if len(_simhash_features) >= _SIMHASH_CACHE_SIZE:
+            _simhash_features.clear()
+        digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+        counts = int.from_bytes(b''.join([_SIMHASH_SPREAD[byte] for byte in reversed(digest)]), 'little')
+        _simhash_features[feature] = counts
+    return counts
+
+def simhash(text):
+    """64-bit SimHash of the normalised text over word unigrams and bigrams, or None for short texts."""
+    tokens = normalize_listing_text(text).split()
+    if len(tokens) < NEAR_DUP_MIN_TOKENS:
+        return None
+    features = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    # Біт встановлено, якщо його мають більше половини ознак: зсуваємо лічильники так,
+    # щоб це означало старший біт, і збираємо старші байти в рядок із 64 нулів та одиниць
+    counts = sum(map(_feature_counts, features)) + _SIMHASH_ONES * (0x7FFF - len(features) // 2)
+    bits = counts.to_bytes(128, 'little')[1::2].translate(_SIMHASH_HIGH_BIT)
+    return int(bits[::-1], 2)
+
+def _to_int64(fingerprint):
+    # MongoDB зберігає лише знакові 64-бітні цілі
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+class NearDuplicateIndex:
+    """In-memory SimHash index for spotting the same listing reposted with small edits.
+
+    Fingerprints are split into `bands` chunks. By the pigeonhole principle
+    two fingerprints within `max_distance` bits differ in at most
+    `max_distance // bands` bits of some chunk, so a lookup probes each
+    chunk's bucket for every value within that many bits of the query's chunk.
+    Two 32-bit chunks keep almost every bucket to a single entry even though
+    listings share most of their words. Entries live in compact arrays, and a
+    bucket holds a bare entry index until a second entry joins it, to keep
+    millions of posts in memory.
+    """
+
+    def __init__(self, bands=2, max_distance=NEAR_DUP_MAX_DISTANCE, price_tolerance=NEAR_DUP_PRICE_TOLERANCE):
+        if max_distance >= 3 * bands:
+            raise ValueError(f"max_distance must be below three times the number of bands ({bands})")
+        self.bands = bands
+        self.max_distance = max_distance
+        self.price_tolerance = price_tolerance
+        radius = max_distance // bands
+        self._chunks = []  # (зсув, маска, XOR-маски проб) для кожної частини
+        shift = 0
+        for band in range(bands):
+            width = 64 // bands + (band < 64 % bands)
+            probes = [
+                sum(1 << bit for bit in flipped)
+                for flips in range(radius + 1) for flipped in itertools.combinations(range(width), flips)
+            ]
+            self._chunks.append((shift, (1 << width) - 1, probes))
+            shift += width
+        self._buckets = [{} for _ in range(bands)]  # chunk value -> entry index or array of them
+        self._fingerprints = array('Q')
+        self._prices = array('d')
+        self._source_ids = array('I')
+        self._message_ids = array('q')
+        self._sources = []
+        self._source_index = {}
+        self.lookups = 0
+        self.duplicates = 0
+        self.lookup_seconds = 0.0
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def _bands_of(self, fingerprint):
+        return [(fingerprint >> shift) & mask for shift, mask, _ in self._chunks]
+
+    def add(self, fingerprint, price, source, message_id):
+        index = len(self._fingerprints)
+        source_id = self._source_index.get(source)
+        if source_id is None:
+            source_id = self._source_index[source] = len(self._sources)
+            self._sources.append(source)
+        self._fingerprints.append(fingerprint)
+        self._prices.append(price or 0.0)
+        self._source_ids.append(source_id)
+        self._message_ids.append(message_id)
+        for bucket, value in zip(self._buckets, self._bands_of(fingerprint)):
+            entries = bucket.get(value)
+            if entries is None:
+                bucket[value] = index
+            elif isinstance(entries, int):
+                bucket[value] = array('I', (entries, index))
+            else:
+                entries.append(index)
+
+    def find(self, fingerprint, price, source=None, message_id=None):
+        """Return (source, message_id) of an earlier near-duplicate, or None.
+
+        The entry of the post itself (same `source` and `message_id`) is never a match.
+        """
+        started = time.perf_counter()
+        self.lookups += 1
+        try:
+            own_source_id = self._source_index.get(source)
+            seen = set()
+            for bucket, (shift, mask, probes) in zip(self._buckets, self._chunks):
+                value = (fingerprint >> shift) & mask
+                for probe in probes:
+                    entries = bucket.get(value ^ probe)
+                    if entries is None:
+                        continue
+                    for index in (entries,) if isinstance(entries, int) else entries:
+                        if index in seen:
+                            continue
+                        seen.add(index)
+                        if bin(self._fingerprints[index] ^ fingerprint).count('1') > self.max_distance:
+                            continue
+                        if self._source_ids[index] == own_source_id and self._message_ids[index] == message_id:
+                            continue
+                        other_price = self._prices[index]
+                        tolerance = max(price, other_price) * self.price_tolerance
+                        if price and other_price and abs(price - other_price) > tolerance:
+                            continue
+                        self.duplicates += 1
+                        return self._sources[self._source_ids[index]], self._message_ids[index]
+            return None
+        finally:
+            self.lookup_seconds += time.perf_counter() - started
+
+    async def load(self):
+        """Load fingerprints of recent posts from MongoDB."""
+        cutoff = datetime.utcnow() - timedelta(days=NEAR_DUP_WINDOW_DAYS)
+        started = time.monotonic()
+        try:
+            cursor = mongo_client.car_bot.posts.find(
+                {'simhash': {'$exists': True}, 'posted_at': {'$gte': cutoff}},
+                {'_id': 0, 'simhash': 1, 'price': 1, 'source': 1, 'original_id': 1}
+            )
+            async for doc in cursor:
+                self.add(doc['simhash'] & _SIMHASH_MASK, doc.get('price'), doc['source'], doc['original_id'])
+        except Exception as e:
+            logger.error(f"Error loading near-duplicate index: {e}")
+        logger.info(f"Near-duplicate index loaded {len(self)} posts in {time.monotonic() - started:.1f}s")
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'lookups': self.lookups,
+            'duplicates': self.duplicates,
+            'avg_lookup_us': round(self.lookup_seconds / self.lookups * 1e6, 1) if self.lookups else 0.0,
+        }
+
+near_duplicates = NearDuplicateIndex()
+metrics.add_collector('near_duplicates', near_duplicates.stats)
+
+def mark_near_duplicate(post_data):
+    """Fingerprint a post and look up an earlier copy in the near-duplicate index.
+
+    Sets `simhash` (and `duplicate_of` for a repost) on `post_data` and
+    returns True if an earlier copy of the listing was already seen. The post
+    itself enters the index only once stored, see `index_near_duplicate`.
+    """
+    fingerprint = simhash(post_data['text'])
+    if fingerprint is None:
+        return False
+    source = normalize_source(post_data['source'])
+    post_data['simhash'] = _to_int64(fingerprint)
+    original = near_duplicates.find(fingerprint, post_data.get('price'), source, post_data['original_id'])
+    if original is None:
+        return False
+    post_data['duplicate_of'] = {'source': original[0], 'original_id': original[1]}
+    return True
+
+def index_near_duplicate(post_data):
+    """Add a stored post to the near-duplicate index so later reposts point to it."""
+    if 'simhash' in post_data:
+        near_duplicates.add(
+            post_data['simhash'] & _SIMHASH_MASK, post_data.get('price'),
+            normalize_source(post_data['source']), post_data['original_id']
+        )
+
+class BufferedPostWriter:
+    """Accumulate post documents and write them with unordered insert_many.
+
+    A batch is flushed when it reaches `max_size` documents or `max_delay`
+    seconds after its first document. Duplicate-key errors mean "already seen":
+    `on_inserted(docs)` is called once per flush with the documents added with
+    that callback that were actually inserted.
+    """
+
+    def __init__(self, max_size=POSTS_BATCH_SIZE, max_delay=POSTS_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._buffer = []  # (doc, on_inserted)
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self.flushes = 0
+        self.inserted = 0
+        self.duplicates = 0
+
+    async def add(self, doc, on_inserted=None):
+        doc['source'] = normalize_source(doc['source'])
+        self._buffer.append((doc, on_inserted))
+        if len(self._buffer) >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all buffered documents now. Returns False if some could not be written."""
+        async with self._lock:
+            if self._timer is not None and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+            self._timer = None
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return True
+            
+            failed = set()
+            write_errors = 0
+            try:
+                with metrics.timed('mongo_insert_many'):
+                    await mongo_client.car_bot.posts.insert_many([doc for doc, _ in batch], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    failed.add(error['index'])
+                    if error.get('code') != 11000:
+                        write_errors += 1
+                        logger.error(f"Error writing post: {error.get('errmsg')}")
+            except Exception as e:
+                # Повертаємо пакет у буфер, щоб спробувати ще раз
+                logger.error(f"Error flushing {len(batch)} posts, will retry: {e}")
+                self._buffer[:0] = batch
+                self._timer = asyncio.create_task(self._flush_later())
+                return False
+            
+            self.flushes += 1
+            self.duplicates += len(failed)
+            metrics.inc('deduplicated', len(failed))
+            self.inserted += len(batch) - len(failed)
+            logger.info(f"Flushed {len(batch)} posts ({len(batch) - len(failed)} new, {len(failed)} already seen)")
+        
+        inserted = {}
+        for index, (doc, on_inserted) in enumerate(batch):
+            if index not in failed and on_inserted is not None:
+                inserted.setdefault(on_inserted, []).append(doc)
+        for on_inserted, docs in inserted.items():
+            try:
+                await on_inserted(docs)
+            except Exception as e:
+                logger.error(f"Error handling {len(docs)} inserted posts: {e}")
+        return not write_errors
+
+    def stats(self):
+        return {
+            'buffered': len(self._buffer),
+            'flushes': self.flushes,
+            'inserted': self.inserted,
+            'duplicates': self.duplicates,
+        }
+
+post_writer = BufferedPostWriter()
+metrics.add_collector('post_writer', post_writer.stats)
+
+class TokenBucket:
+    """Asyncio token-bucket rate limiter."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def try_acquire(self):
+        """Take a token if one is available; otherwise return the seconds until one is."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Block the bucket for `seconds`, e.g. after a FloodWait."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class DeliveryQueue:
+    """Rate-limited outbound queue for bot messages, persisted in the outbox collection.
+
+    `enqueue` never waits for delivery: the message is stored in MongoDB and
+    sent by background workers that respect global and per-chat limits.
+    Each chat has its own queue; workers take chats from a ready queue and
+    only send when the chat's bucket has a token, otherwise the chat is
+    rescheduled for when it will have one. A slow group therefore never holds
+    a worker while other chats wait. Pending messages survive a restart and
+    are reloaded by `load_pending`.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS):
+        self.workers = workers
+        self._chats = {}  # chat_id -> deque повідомлень; чат є тут, поки він запланований
+        self._ready = asyncio.Queue()  # chat ID, які можна обслужити
+        self._unfinished = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._global_bucket = TokenBucket(DELIVERY_GLOBAL_RATE, capacity=DELIVERY_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.latencies = deque(maxlen=1000)
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Від'ємні ID — групи та канали з жорсткішим лімітом
+            rate = DELIVERY_GROUP_RATE if str(chat_id).startswith('-') else DELIVERY_CHAT_RATE
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate)
+        return bucket
+
+    async def enqueue(self, chat_id, text):
+        """Persist a message and queue it for delivery."""
+        await self.enqueue_many([(chat_id, text)])
+
+    async def enqueue_many(self, messages):
+        """Persist (chat_id, text) pairs with one insert_many and queue them for delivery."""
+        now = datetime.utcnow()
+        docs = [{'chat_id': chat_id, 'text': text, 'created_at': now, 'attempts': 0} for chat_id, text in messages]
+        if not docs:
+            return
+        try:
+            await mongo_client.car_bot.outbox.insert_many(docs, ordered=False)
+        except Exception as e:
+            logger.error(f"Error persisting {len(docs)} outgoing messages, sending from memory only: {e}")
+        for doc in docs:
+            self._put(doc)
+
+    def _put(self, doc):
+        self._unfinished += 1
+        self._idle.clear()
+        self._push(doc)
+
+    def _push(self, doc, front=False):
+        # Повідомлення, що повертається на повтор, уже враховане в _unfinished
+        pending = self._chats.get(doc['chat_id'])
+        if pending is None:
+            pending = self._chats[doc['chat_id']] = deque()
+            self._ready.put_nowait(doc['chat_id'])
+        if front:
+            pending.appendleft(doc)
+        else:
+            pending.append(doc)
+
+    def _done(self):
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+
+    async def load_pending(self):
+        """Queue messages left unsent by a previous run."""
+        try:
+            docs = await mongo_client.car_bot.outbox.find().sort('created_at', 1).to_list(length=None)
+        except Exception as e:
+            logger.error(f"Error loading pending outgoing messages: {e}")
+            return
+        for doc in docs:
+            self._put(doc)
+        if docs:
+            logger.info(f"Loaded {len(docs)} pending outgoing messages")
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def drain(self, timeout=30):
+        """Wait for queued messages to be sent, then stop the workers."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Delivery queue not drained, {self._unfinished} messages stay in outbox")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._serve(chat_id)
+            except Exception as e:
+                logger.error(f"Error in delivery worker: {e}")
+
+    async def _serve(self, chat_id):
+        """Send the chat's next message if its limit allows, then reschedule the chat."""
+        pending = self._chats[chat_id]
+        wait = self._bucket(chat_id).try_acquire()
+        if wait:
+            # Чат чекає на свій ліміт без воркера — інші чати тим часом обслуговуються
+            asyncio.get_running_loop().call_later(wait, self._ready.put_nowait, chat_id)
+            return
+        doc = pending.popleft()
+        try:
+            await self._send(doc)
+        finally:
+            if pending:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    async def _send(self, doc):
+        chat_bucket = self._bucket(doc['chat_id'])
+        await self._global_bucket.acquire()
+        try:
+            with metrics.timed('send_message'):
+                await bot_client.send_message(doc['chat_id'], doc['text'])
+        except errors.FloodWaitError as e:
+            self.flood_waits += 1
+            logger.warning(f"FloodWait of {e.seconds}s sending to {doc['chat_id']}, requeueing")
+            chat_bucket.pause(e.seconds)
+            self._push(doc, front=True)
+            return
+        except Exception as e:
+            doc['attempts'] = doc.get('attempts', 0) + 1
+            if doc['attempts'] < DELIVERY_MAX_ATTEMPTS:
+                delay = 2 ** doc['attempts']
+                logger.error(f"Error sending message to {doc['chat_id']} (attempt {doc['attempts']}), retrying in {delay}s: {e}")
+                asyncio.get_running_loop().call_later(delay, self._push, doc)
+                return
+            logger.error(f"Giving up on message to {doc['chat_id']} after {doc['attempts']} attempts: {e}")
+            self.failed += 1
+            metrics.inc('failed')
+        else:
+            self.sent += 1
+            metrics.inc('forwarded')
+            self.latencies.append((datetime.utcnow() - doc['created_at']).total_seconds())
+            logger.info(f"✅ Переслано в {doc['chat_id']}")
+        
+        self._done()
+        if doc.get('_id') is not None:
+            try:
+                await mongo_client.car_bot.outbox.delete_one({'_id': doc['_id']})
+            except Exception as e:
+                logger.error(f"Error removing delivered message from outbox: {e}")
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'depth': sum(len(pending) for pending in self._chats.values()),
+            'chats': len(self._chats),
+            'sent': self.sent,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+delivery_queue = DeliveryQueue()
+metrics.add_collector('delivery', delivery_queue.stats)
+
+class SubscriptionIndex:
+    """In-memory inverted index of subscriber filters.
+
+    Each filter is posted under (brand, model, price band) keys, where a
+    missing brand or model is a wildcard and the bands cover its price range
+    in SUBSCRIPTION_PRICE_BAND steps. Matching a post looks up at most four
+    keys for its price band and checks only those candidates, so the cost
+    depends on how many filters overlap the post, not on the total count.
+    Every filter has an upper bound: MAX_PRICE_USD when none was given, and
+    never more than `cap`.
+    """
+
+    def __init__(self, band=SUBSCRIPTION_PRICE_BAND, cap=SUBSCRIPTION_PRICE_CAP):
+        self.band = band
+        self.cap = cap
+        self.filters = {}  # filter id -> filter document
+        self._index = {}  # (brand, model, band) -> set of filter ids
+        self._ceiling = None
+        self.matches = 0
+        self.candidates = 0
+
+    def _band(self, price):
+        return int(price // self.band)
+
+    def _keys(self, subscription):
+        brand = (subscription.get('brand') or '').lower() or None
+        model = (subscription.get('model') or '').lower() or None
+        low = subscription.get('min_price') or 0
+        bands = range(self._band(low), self._band(subscription['max_price']) + 1)
+        return [(brand, model, band) for band in bands]
+
+    def add(self, subscription):
+        # Без верхньої межі одна підписка скасувала б ціновий префільтр для всіх
+        high = subscription.get('max_price')
+        subscription['max_price'] = MAX_PRICE_USD if high is None else min(high, self.cap)
+        filter_id = str(subscription['_id'])
+        self.remove(filter_id)
+        self.filters[filter_id] = subscription
+        self._ceiling = None
+        for key in self._keys(subscription):
+            self._index.setdefault(key, set()).add(filter_id)
+
+    def remove(self, filter_id):
+        subscription = self.filters.pop(str(filter_id), None)
+        if subscription is None:
+            return False
+        self._ceiling = None
+        for key in self._keys(subscription):
+            ids = self._index.get(key)
+            if ids is not None:
+                ids.discard(str(filter_id))
+                if not ids:
+                    del self._index[key]
+        return True
+
+    def price_ceiling(self):
+        """Highest price any subscriber accepts (MAX_PRICE_USD when there are no filters)."""
+        if self._ceiling is None:
+            highs = [subscription['max_price'] for subscription in self.filters.values()]
+            self._ceiling = max(highs) if highs else MAX_PRICE_USD
+        return self._ceiling
+
+    def match(self, price, car_info=None, source=None):
+        """Return the chat IDs whose filters accept a post."""
+        car_info = car_info or {}
+        brand = (car_info.get('brand') or '').lower() or None
+        model = (car_info.get('model') or '').lower() or None
+        year = car_info.get('year')
+        band = self._band(price)
+        
+        candidate_ids = set()
+        for key_brand, key_model in {(brand, model), (brand, None), (None, model), (None, None)}:
+            candidate_ids |= self._index.get((key_brand, key_model, band), set())
+        self.candidates += len(candidate_ids)
+        
+        chat_ids = []
+        for filter_id in candidate_ids:
+            subscription = self.filters[filter_id]
+            if price < (subscription.get('min_price') or 0):
+                continue
+            if price > subscription['max_price']:
+                continue
+            if subscription.get('year_from') and (not year or year < subscription['year_from']):
+                continue
+            if subscription.get('sources') and normalize_source(source or '') not in subscription['sources']:
+                continue
+            if subscription['chat_id'] not in chat_ids:
+                chat_ids.append(subscription['chat_id'])
+        self.matches += len(chat_ids)
+        return chat_ids
+
+    async def load(self):
+        """Load saved filters from MongoDB, plus the TARGET_CHAT_ID default."""
+        self.filters = {}
+        self._index = {}
+        self._ceiling = None
+        if TARGET_CHAT_ID:
+            self.add({'_id': 'default', 'chat_id': TARGET_CHAT_ID, 'max_price': MAX_PRICE_USD})
+        try:
+            async for subscription in mongo_client.car_bot.subscriptions.find():
+                self.add(subscription)
+        except Exception as e:
+            logger.error(f"Error loading subscriptions: {e}")
+        if not LIVE_GPT_ANALYSIS:
+            car_filters = [filter_id for filter_id, subscription in self.filters.items() if _car_filter_keys(subscription)]
+            if car_filters:
+                logger.warning(
+                    f"{len(car_filters)} subscriber filters use brand/model/year, which never match "
+                    f"without LIVE_GPT_ANALYSIS: {', '.join(car_filters)}"
+                )
+        logger.info(f"Loaded {len(self.filters)} subscriber filters")
+
+    def stats(self):
+        return {
+            'filters': len(self.filters),
+            'index_keys': len(self._index),
+            'matches': self.matches,
+            'candidates_checked': self.candidates,
+        }
+
+subscription_index = SubscriptionIndex()
+metrics.add_collector('subscriptions', subscription_index.stats)
+
+# Отримувачі нещодавніх оголошень: (source, original_id) -> (ключ оригіналу, set chat ID)
+_recipients_cache = OrderedDict()
+
+def _remember_recipients(key, listing, chat_ids):
+    _recipients_cache[key] = (listing, chat_ids)
+    _recipients_cache.move_to_end(key)
+    while len(_recipients_cache) > RECIPIENTS_CACHE_SIZE:
+        _recipients_cache.popitem(last=False)
+
+async def _listing_recipients(duplicate_of):
+    """Return the original listing's key and the chats that already received it."""
+    cached = _recipients_cache.get((duplicate_of['source'], duplicate_of['original_id']))
+    if cached is not None:
+        return cached[0], set(cached[1])
+    posts = mongo_client.car_bot.posts
+    projection = {'delivered_to': 1, 'duplicate_of': 1, 'price': 1, 'car_info': 1, 'source': 1}
+    listing = duplicate_of
+    doc = await posts.find_one(listing, projection)
+    if doc is not None and doc.get('duplicate_of'):
+        # Індекс міг знайти іншу копію — отримувачів зберігаємо на першому пості оголошення
+        listing = doc['duplicate_of']
+        doc = await posts.find_one(listing, projection)
+    if doc is None:
+        return listing, set()
+    if 'delivered_to' not in doc:
+        # Пости, збережені до обліку отримувачів, пересилали всім, чиї фільтри їх приймають
+        return listing, set(subscription_index.match(doc.get('price') or 0, doc.get('car_info'), doc.get('source')))
+    return listing, set(doc['delivered_to'])
+
+async def _select_recipients(post):
+    """Return the chats a post goes to and the key of the listing they are recorded on.
+
+    A near-duplicate (`duplicate_of` set) goes only to subscribers that have
+    not received the original listing. The recipients cache is updated right
+    away so a repost later in the same batch already sees them.
+    """
+    chat_ids = subscription_index.match(post['price'], post.get('car_info'), post['source'])
+    listing = {'source': normalize_source(post['source']), 'original_id': post['original_id']}
+    delivered = set()
+    if post.get('duplicate_of') and chat_ids:
+        listing, delivered = await _listing_recipients(post['duplicate_of'])
+        chat_ids = [chat_id for chat_id in chat_ids if chat_id not in delivered]
+        if not chat_ids:
+            _remember_recipients((listing['source'], listing['original_id']), listing, delivered)
+            logger.info(f"♻️ Схоже оголошення вже отримали всі підписники: {post['duplicate_of']}")
+            metrics.inc('deduplicated')
+            return chat_ids, listing
+    if not chat_ids:
+        logger.info(f"No subscriber filters match the post from {post['source']} (${post['price']})")
+        return chat_ids, listing
+    
+    recipients = delivered | set(chat_ids)
+    # Копія веде на той самий оригінал, тож кешуємо обидва ключі
+    for key in {(listing['source'], listing['original_id']), (normalize_source(post['source']), post['original_id'])}:
+        _remember_recipients(key, listing, recipients)
+    return chat_ids, listing
+
+async def deliver_batch(items):
+    """Queue forwards for a batch of (text, post) pairs; returns the chat IDs per post.
+
+    Outgoing messages are stored with one outbox insert_many and recipients
+    are recorded on the original posts with one bulk_write per batch.
+    """
+    results = []
+    messages = []
+    recorded = {}  # (source, original_id) -> (ключ оригіналу, list chat ID)
+    for text, post in items:
+        chat_ids, listing = await _select_recipients(post)
+        results.append(chat_ids)
+        if not chat_ids:
+            continue
+        messages.extend((chat_id, text) for chat_id in chat_ids)
+        recorded.setdefault((listing['source'], listing['original_id']), (listing, []))[1].extend(chat_ids)
+    
+    await delivery_queue.enqueue_many(messages)
+    if recorded:
+        updates = [
+            UpdateOne(listing, {'$addToSet': {'delivered_to': {'$each': chat_ids}}})
+            for listing, chat_ids in recorded.values()
+        ]
+        try:
+            with metrics.timed('mongo_record_recipients'):
+                await mongo_client.car_bot.posts.bulk_write(updates, ordered=False)
+        except Exception as e:
+            logger.error(f"Error recording recipients of {len(updates)} posts: {e}")
+    return results
+
+async def deliver_to_subscribers(text, post):
+    """Queue a forward for every subscriber whose filters accept the post."""
+    return (await deliver_batch([(text, post)]))[0]
+
+async def start_user_sessions():
+    """Connect the pool of user accounts that read the sources."""
+    global user_client
+    if user_client is None:
+        logger.info(f"Setting up user sessions for reading messages: {user_pool.names}")
+        await user_pool.start()
+        user_client = user_pool.clients.get(user_pool.primary) or next(iter(user_pool.clients.values()))
+        logger.info("User sessions started successfully")
+
+async def start_bot_client():
+    """Connect the bot client that sends messages."""
+    global bot_client
+    if bot_client is None:
+        logger.info("Setting up bot client for sending messages")
+        bot_client = TelegramClient('bot_session', API_ID, API_HASH)
+        await bot_client.start(bot_token=BOT_TOKEN)
+        logger.info("Bot client started successfully")
+
+async def attach_user_sessions():
+    """Assign sources to the connected sessions and register their message handlers."""
+    logger.info(f"Monitoring sources: {source_registry.list()}")
+    
+    # Розподіляємо джерела між сесіями, визначаємо їх ID і реєструємо обробники лише для них
+    await user_pool.rebalance()
+    await resolve_source_ids()
+    register_message_handler()
+    source_registry.subscribe(register_message_handler)
+
+class LiveWatermarks:
+    """Advance source watermarks only past messages the live path has finished.
+
+    A message is in flight from the moment the handler receives it until it
+    leaves the pipeline (delivered or dropped). A chat's mark never passes its
+    oldest in-flight message, so after a crash the catch-up backfill still
+    sees every unfinished one. A message whose stage raised holds the mark
+    back the same way until a backfill pass has re-read it (`covered`).
+    Marks are written to MongoDB at most every `interval` seconds.
+    """
+
+    def __init__(self, interval=WATERMARK_FLUSH_INTERVAL):
+        self.interval = interval
+        self._in_flight = {}  # chat_id -> set of message IDs
+        self._failed = {}  # chat_id -> set of message IDs, що чекають на backfill
+        self._finished = {}  # chat_id -> highest finished message ID
+        self._pending = {}  # source -> mark waiting to be written
+        self._flusher = None
+        self.writes = 0
+
+    def begin(self, chat_id, message_id):
+        self._in_flight.setdefault(chat_id, set()).add(message_id)
+
+    def _leave(self, chat_id, message_id):
+        in_flight = self._in_flight.get(chat_id)
+        if in_flight is not None:
+            in_flight.discard(message_id)
+            if not in_flight:
+                del self._in_flight[chat_id]
+
+    def finish(self, chat_id, message_id, source=None):
+        self._leave(chat_id, message_id)
+        self._finished[chat_id] = max(self._finished.get(chat_id, 0), message_id)
+        self._advance(chat_id, source or source_registry.chat_ids.get(chat_id))
+
+    def fail(self, chat_id, message_id):
+        """Take a message out of flight without letting the mark pass it."""
+        self._leave(chat_id, message_id)
+        source = source_registry.chat_ids.get(chat_id)
+        if source is not None and message_id <= source_registry.watermarks.get(source, 0):
+            return  # backfill уже прочитав це повідомлення
+        self._failed.setdefault(chat_id, set()).add(message_id)
+
+    def covered(self, source, message_id):
+        """Forget failed messages of `source` up to `message_id` once a backfill has re-read them."""
+        for chat_id, username in source_registry.chat_ids.items():
+            failed = self._failed.get(chat_id)
+            if username != source or failed is None:
+                continue
+            failed.difference_update([failed_id for failed_id in failed if failed_id <= message_id])
+            if not failed:
+                del self._failed[chat_id]
+            self._advance(chat_id, source)
+
+    def _advance(self, chat_id, source):
+        finished = self._finished.get(chat_id)
+        if source is None or finished is None:
+            return
+        blocked = self._in_flight.get(chat_id, set()) | self._failed.get(chat_id, set())
+        mark = min(finished, min(blocked) - 1) if blocked else finished
+        if mark > max(self._pending.get(source, 0), source_registry.watermarks.get(source, 0)):
+            self._pending[source] = mark
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write all pending marks now."""
+        pending, self._pending = self._pending, {}
+        for source, mark in pending.items():
+            await source_registry.advance_watermark(source, mark)
+            self.writes += 1
+
+    def stats(self):
+        return {
+            'in_flight': sum(len(ids) for ids in self._in_flight.values()),
+            'failed': sum(len(ids) for ids in self._failed.values()),
+            'pending': len(self._pending),
+            'writes': self.writes,
+        }
+
+live_watermarks = LiveWatermarks()
+metrics.add_collector('live_watermarks', live_watermarks.stats)
+
+async def message_handler(event, session=None):
+    """Hand a new message to the ingestion pipeline; all processing happens in its stages.
+
+    `session` is set for handlers registered without a chat filter: messages
+    from a known source that another session reads are dropped here.
+    """
+    if session is not None:
+        source = source_registry.chat_ids.get(event.chat_id)
+        if source is not None and user_pool.session_for(source)[0] != session:
+            return
+    metrics.inc('seen')
+    live_watermarks.begin(event.chat_id, event.message.id)
+    if event.message.grouped_id:
+        # Альбом приходить окремими повідомленнями — обробляємо його один раз
+        album_coalescer.add(event)
+        return
+    await ingest_pipeline.submit(event)
+
+class AlbumCoalescer:
+    """Collapse album items sharing a grouped_id into a single pipeline event.
 
-# Global variables
-user_client = None  # Клієнт для читання повідомлень (звичайний акаунт)
-bot_client = None   # Клієнт для відправки повідомлень (бот)
-application = None
-mongo_client = None
+    Items are buffered until no new item of the album arrives for `window`
+    seconds; then the item carrying the caption (or the first one) is submitted.
+    """
 
-async def init_mongodb():
-    global mongo_client
-    try:
-        mongo_client = AsyncIOMotorClient(MONGO_URI)
-        await mongo_client.admin.command('ping')
-        logger.info("Successfully connected to MongoDB and verified connection")
-        return mongo_client
-    except Exception as e:
-        logger.error(f"Failed to connect to MongoDB: {e}")
-        raise
+    def __init__(self, window=ALBUM_WINDOW):
+        self.window = window
+        self._albums = {}  # (chat_id, grouped_id) -> {'events': [...], 'timer': TimerHandle}
+        self.albums = 0
+        self.items = 0
 
-async def setup_clients():
-    """Setup both Telethon clients - user account and bot."""
-    global user_client, bot_client
-    
-    # Налаштовуємо клієнт для читання повідомлень (звичайний акаунт)
-    if user_client is None:
-        logger.info("Setting up user client for reading messages")
-        user_client = TelegramClient('user_session', API_ID, API_HASH)
-        await user_client.start()
-        logger.info("User client started successfully")
-        
-        # Отримуємо список джерел для моніторингу
-        sources = await get_monitored_sources()
-        logger.info(f"Monitoring sources: {sources}")
-        
-        @user_client.on(events.NewMessage())
-        async def message_handler(event):
+    def add(self, event):
+        key = (event.chat_id, event.message.grouped_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = {'events': [], 'timer': None}
+        else:
+            album['timer'].cancel()
+        album['events'].append(event)
+        self.items += 1
+        album['timer'] = asyncio.get_running_loop().call_later(
+            self.window, lambda: asyncio.create_task(self._flush(key))
+        )
+
+    async def _flush(self, key):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return
+        album['timer'].cancel()
+        self.albums += 1
+        event = next((e for e in album['events'] if e.message.text), album['events'][0])
+        logger.info(f"Album {key[1]}: {len(album['events'])} items coalesced into message {event.message.id}")
+        # Решта елементів альбому обробляється разом із вибраним — у польоті лишається лише він
+        for other in album['events']:
+            if other is not event:
+                live_watermarks.finish(other.chat_id, other.message.id)
+        await ingest_pipeline.submit(event)
+
+    async def flush_all(self):
+        """Submit all pending albums now (used on shutdown)."""
+        for key in list(self._albums):
+            await self._flush(key)
+
+    def stats(self):
+        return {
+            'albums': self.albums,
+            'album_items': self.items,
+            'handler_invocations_saved': self.items - self.albums - sum(len(a['events']) for a in self._albums.values()),
+            'pending': len(self._albums),
+        }
+
+album_coalescer = AlbumCoalescer()
+metrics.add_collector('albums', album_coalescer.stats)
+
+class PipelineStage:
+    """One stage of the ingestion pipeline: a bounded queue served by a pool of workers.
+
+    `handler(item)` returns the item for the next stage, or None to drop it.
+    `on_done(item)` is called when an item leaves the pipeline at this stage,
+    `on_failed(item)` when the handler raised on it.
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize)
+        self.next = None
+        self.on_done = None
+        self.on_failed = None
+        self._tasks = []
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            started = time.perf_counter()
+            failed = False
             try:
-                # Отримуємо інформацію про чат
-                chat = await event.get_chat()
-                chat_username = f"@{chat.username}" if chat.username else str(chat.id)
-                
-                # Отримуємо актуальний список джерел
-                sources = await get_monitored_sources()
-                
-                # Перевіряємо чи це повідомлення з моніторингового каналу
-                if chat_username in sources:
-                    logger.info(f"✅ Нове повідомлення з {chat_username}")
-                    logger.info(f"📝 Текст: {event.message.text}")
-                    
-                    # Перевіряємо наявність ціни
-                    price = extract_price(event.message.text)
-                    if price is not None:
-                        logger.info(f"💰 Знайдено ціну: ${price}")
-                        
-                        if price <= 10000:
-                            logger.info(f"✨ Ціна ${price} в межах ліміту")
-                            
-                            # Пересилаємо повідомлення через бота
-                            target_chat_id = os.getenv('TARGET_CHAT_ID')
-                            source_link = f"https://t.me/{chat.username}/{event.message.id}"
-                            forward_text = f"🚗 Нова пропозиція: ${price}\n\nДжерело: {source_link}"
-                            
-                            if bot_client:
-                                await bot_client.send_message(target_chat_id, forward_text)
-                                logger.info(f"✅ Переслано в {target_chat_id}")
-                        else:
-                            logger.info(f"❌ Ціна ${price} перевищує ліміт")
-                    else:
-                        logger.info("❌ Ціну не знайдено в повідомленні")
+                result = await self.handler(item)
             except Exception as e:
-                logger.error(f"❌ Помилка: {e}", exc_info=True)
+                self.failed += 1
+                metrics.inc('failed')
+                logger.error(f"❌ Помилка на етапі {self.name}: {e}", exc_info=True)
+                result = None
+                failed = True
+            else:
+                self.processed += 1
+                if result is None:
+                    self.dropped += 1
+            finally:
+                elapsed = time.perf_counter() - started
+                self.busy_seconds += elapsed
+                metrics.observe(f'stage_{self.name}', elapsed)
+            try:
+                if result is not None and self.next is not None:
+                    # Повна черга наступного етапу пригальмовує цей етап (backpressure)
+                    await self.next.queue.put(result)
+                else:
+                    # Елемент покинув конвеєр: доставлений, відкинутий або з помилкою
+                    callback = self.on_failed if failed else self.on_done
+                    try:
+                        if callback is not None:
+                            callback(item if result is None else result)
+                    except Exception as e:
+                        logger.error(f"Error finishing item on stage {self.name}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        handled = self.processed + self.failed
+        return {
+            'depth': self.queue.qsize(),
+            'workers': self.workers,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'avg_seconds': round(self.busy_seconds / handled, 4) if handled else 0.0,
+        }
+
+class IngestionPipeline:
+    """Chain of PipelineStages connected by bounded queues."""
+
+    def __init__(self, stages, on_done=None, on_failed=None):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        for stage in stages:
+            stage.on_done = on_done
+            stage.on_failed = on_failed
+
+    async def submit(self, item):
+        await self.stages[0].queue.put(item)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    async def drain(self, timeout=30):
+        """Wait until queued items pass through every stage, then stop the workers."""
+        async def join_all():
+            for stage in self.stages:
+                await stage.queue.join()
+        try:
+            await asyncio.wait_for(join_all(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Ingestion pipeline not drained: {self.stats()}")
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+async def receive_stage(event):
+    """Capture what later stages need from the Telethon event."""
+    return {
+        'event': event,
+        'chat_id': event.chat_id,
+        'message': event.message,
+        'received_at': time.monotonic(),
+    }
+
+async def filter_stage(item):
+    """Drop messages that are not from a monitored source."""
+    # Без фільтра на рівні Telethon отримуємо username лише для невідомих ID
+    username = None
+    if item['chat_id'] not in source_registry.chat_ids and not HANDLER_CHAT_FILTER:
+        with metrics.timed('get_chat'):
+            chat = await item['event'].get_chat()
+        username = f"@{chat.username}" if chat.username else str(chat.id)
     
-    # Налаштовуємо клієнт для відправки повідомлень (бот)
-    if bot_client is None:
-        logger.info("Setting up bot client for sending messages")
-        bot_client = TelegramClient('bot_session', API_ID, API_HASH)
-        await bot_client.start(bot_token=BOT_TOKEN)
-        logger.info("Bot client started successfully")
+    # Перевіряємо чи це повідомлення з моніторингового каналу (без запиту до БД)
+    with metrics.timed('source_lookup'):
+        source = source_registry.match(username, item['chat_id'])
+    if not source:
+        metrics.inc('filtered')
+        return None
+    logger.info(f"✅ Нове повідомлення з {source}")
+    logger.info(f"📝 Текст: {item['message'].text}")
+    item['source'] = source
+    startup_timer.mark_first_message()
+    return item
+
+async def classify_stage(item):
+    """Extract the price (and, if enabled, the GPT analysis) and drop non-matching posts."""
+    text = item['message'].text
+    price = extract_price(text)
+    item['car_info'] = None
+    
+    if LIVE_GPT_ANALYSIS:
+        analysis = await classify_message(text)
+        if analysis is None:
+            # GPT недоступний після всіх повторів — не губимо пост, а йдемо за ціною з regex
+            logger.warning("GPT analysis failed, falling back to the extracted price")
+            metrics.inc('analysis_fallback')
+        elif not analysis.get('is_car_sale'):
+            logger.info("❌ Не оголошення про продаж авто")
+            metrics.inc('filtered')
+            return None
+        else:
+            price = analysis.get('price_usd') or price
+            item['car_info'] = analysis.get('car_info')
+    
+    if price is None:
+        logger.info("❌ Ціну не знайдено в повідомленні")
+        metrics.inc('filtered')
+        return None
+    logger.info(f"💰 Знайдено ціну: ${price}")
+    if price > subscription_index.price_ceiling():
+        logger.info(f"❌ Ціна ${price} перевищує ліміт")
+        metrics.inc('filtered')
+        return None
+    logger.info(f"✨ Ціна ${price} в межах ліміту")
+    item['price'] = price
+    return item
+
+async def persist_stage(item):
+    """Store the post; duplicates stop here."""
+    message = item['message']
+    post_data = {
+        'text': message.text,
+        'source': item['source'],
+        'posted_at': datetime.utcnow(),
+        'original_id': message.id,
+        'price': item['price'],
+        'message_date': message.date
+    }
+    if item['car_info']:
+        post_data['car_info'] = item['car_info']
+    # Копію з іншого каналу теж зберігаємо: deliver_stage перешле її лише тим, хто не отримав оригінал
+    mark_near_duplicate(post_data)
+    
+    # Той самий ключ, що й в історичному скануванні — пост не перешлемо двічі
+    if not await save_post(post_data):
+        logger.info("♻️ Повідомлення вже є в базі")
+        metrics.inc('deduplicated')
+        return None
+    index_near_duplicate(post_data)
+    item['post'] = post_data
+    return item
+
+async def deliver_stage(item):
+    """Queue the forward for every matching subscriber."""
+    source_link = f"https://t.me/{item['source'].lstrip('@')}/{item['message'].id}"
+    forward_text = f"🚗 Нова пропозиція: ${item['price']}\n\nДжерело: {source_link}"
+    await deliver_to_subscribers(forward_text, item['post'])
+    return item
+
+def finish_pipeline_item(item):
+    """Mark a message as finished once it leaves the pipeline, so its source's watermark can move."""
+    # На етапі receive елемент ще подія Telethon, далі — словник
+    if isinstance(item, dict):
+        live_watermarks.finish(item['chat_id'], item['message'].id, item.get('source'))
+    else:
+        live_watermarks.finish(item.chat_id, item.message.id)
+
+def fail_pipeline_item(item):
+    """Hold the source's watermark below a message whose stage raised, so backfill re-reads it."""
+    if isinstance(item, dict):
+        live_watermarks.fail(item['chat_id'], item['message'].id)
+    else:
+        live_watermarks.fail(item.chat_id, item.message.id)
+
+ingest_pipeline = IngestionPipeline([
+    PipelineStage('receive', receive_stage, PIPELINE_WORKERS.get('receive', 1)),
+    PipelineStage('filter', filter_stage, PIPELINE_WORKERS.get('filter', 1)),
+    PipelineStage('classify', classify_stage, PIPELINE_WORKERS.get('classify', 4)),
+    PipelineStage('persist', persist_stage, PIPELINE_WORKERS.get('persist', 2)),
+    PipelineStage('deliver', deliver_stage, PIPELINE_WORKERS.get('deliver', 1)),
+], on_done=finish_pipeline_item, on_failed=fail_pipeline_item)
+metrics.add_collector('pipeline', lambda: {'stages': ingest_pipeline.stats()}, label='stage')
+
+def register_message_handler():
+    """(Re)register the message handler on every session, bound to the chats it owns."""
+    user_pool.register_handlers()
+
+async def _resolve_entities(session, client, usernames):
+    # Закешовані джерела визначаємо локально, по мережі — лише решту
+    entities = {username: entity_cache.get(session, username) for username in usernames}
+    missing = [username for username, entity in entities.items() if entity is None]
+    if missing:
+        try:
+            fetched = await client.get_entity(missing)
+        except Exception as e:
+            # Одне невалідне джерело ламає весь пакет — визначаємо поштучно
+            logger.warning(f"Bulk entity resolution failed ({e}), resolving one by one")
+            fetched = []
+            for username in missing:
+                try:
+                    fetched.append(await client.get_entity(username))
+                except Exception as entity_error:
+                    logger.error(f"Failed to resolve source {username}: {entity_error}")
+                    fetched.append(None)
+        for username, entity in zip(missing, fetched):
+            if entity is not None:
+                await entity_cache.store(session, username, entity)
+            entities[username] = entity
+    return [entities[username] for username in usernames]
+
+async def resolve_source_ids():
+    """Resolve peer IDs for sources that don't have one yet and persist them."""
+    unresolved = source_registry.unresolved()
+    if not unresolved or not user_pool.clients:
+        return
+    logger.info(f"Resolving peer IDs for {len(unresolved)} sources")
+    # Кожна сесія визначає лише свої джерела, паралельно з іншими
+    shards = [
+        (*user_pool.session_for(usernames[0]), usernames)
+        for usernames in user_pool.shard(unresolved).values() if usernames
+    ]
+    results = await asyncio.gather(*(_resolve_entities(*shard) for shard in shards))
+    
+    db = mongo_client.car_bot
+    for (_, _, usernames), entities in zip(shards, results):
+        for username, entity in zip(usernames, entities):
+            if entity is None:
+                continue
+            chat_id = telethon_utils.get_peer_id(entity)
+            await db.sources.update_one({'username': username}, {'$set': {'chat_id': chat_id}})
+            source_registry.add(username, chat_id)
+            logger.info(f"Resolved {username} -> {chat_id}")
+
+async def resolve_sources_periodically():
+    """Retry sources whose peer ID could not be resolved, whatever keeps the registry in sync.
+
+    Without a chat ID a source is left out of the handlers' chat filter and
+    only reaches subscribers through backfill, while a change stream would
+    only retry it on the next change to the sources collection.
+    """
+    while True:
+        await asyncio.sleep(SOURCE_RESOLVE_INTERVAL)
+        try:
+            await resolve_source_ids()
+        except Exception as e:
+            logger.error(f"Error resolving source IDs: {e}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
@@ -134,75 +2042,390 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /add_source <username> - Додати нове джерело для парсингу
 /list_sources - Показати всі джерела
 /remove_source <username> - Видалити джерело
+/search <марка> <модель> <макс_ціна> <рік_від> - Пошук по збережених оголошеннях
+/subscribe key=value ... - Підписатися на оголошення (max, min, brand, model, year, sources)
+/filters - Показати фільтри цього чату
+/unsubscribe <id|all> - Видалити фільтр
+/stats - Статистика обробки повідомлень
     """
     await update.message.reply_text(help_text)
 
-async def check_historical_messages(source, hours=72):
-    """Check messages from the last 72 hours in the source channel."""
+SEARCH_USAGE = (
+    'Використання: /search <марка> <модель> <макс_ціна> <рік_від> [сторінка]\n'
+    'Пропустити параметр: * (наприклад /search opel * 6000 2008)'
+)
+
+def _search_car_note(brand, model, year_from):
+    """Explain that brand/model/year only exist on posts analysed by GPT, or return None."""
+    if not (brand or model or year_from):
+        return None
+    if not LIVE_GPT_ANALYSIS:
+        return ('Марку, модель і рік визначає лише аналіз оголошень (LIVE_GPT_ANALYSIS), який вимкнено: '
+                'шукаються тільки пости, проаналізовані раніше. Для решти вкажіть лише ціну.')
+    return 'Марку, модель і рік мають лише нові пости, проаналізовані GPT; історичні пости в пошук не потрапляють.'
+
+def _search_arg(args, index, cast=str):
+    """Return a positional /search argument, or None if it is missing or '*'/'-'."""
+    if len(args) <= index or args[index] in ('*', '-'):
+        return None
+    return cast(args[index])
+
+async def search_posts(brand=None, model=None, max_price=None, year_from=None, page=1, page_size=SEARCH_PAGE_SIZE):
+    """Return one page of stored posts matching the filters, newest first, plus a has-more flag."""
+    query = {}
+    if brand:
+        query['car_info.brand'] = brand
+    if model:
+        query['car_info.model'] = model
+    if max_price is not None:
+        query['price'] = {'$lte': max_price}
+    if year_from is not None:
+        query['car_info.year'] = {'$gte': year_from}
+    
+    projection = {
+        '_id': 0, 'source': 1, 'original_id': 1, 'price': 1, 'message_date': 1,
+        'car_info.brand': 1, 'car_info.model': 1, 'car_info.year': 1,
+    }
+    cursor = (
+        mongo_client.car_bot.posts.find(query, projection, collation=SEARCH_COLLATION)
+        .sort('message_date', -1)
+        .skip((page - 1) * page_size)
+        .limit(page_size + 1)
+    )
+    results = []
+    with metrics.timed('mongo_search'):
+        async for post in cursor:
+            results.append(post)
+    return results[:page_size], len(results) > page_size
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Search stored posts: /search brand model max_price year_from [page]."""
+    logger.info(f"Search command received from user {update.effective_user.id}: {context.args}")
+    args = context.args or []
+    if not args:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+    
     try:
-        logger.info(f"Checking historical messages from {source} for the last {hours} hours")
-        
-        # Get the timestamp from 72 hours ago
-        time_threshold = datetime.now() - timedelta(hours=hours)
+        brand = _search_arg(args, 0)
+        model = _search_arg(args, 1)
+        max_price = _search_arg(args, 2, float)
+        year_from = _search_arg(args, 3, int)
+        page = max(1, _search_arg(args, 4, int) or 1)
+    except ValueError:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+    
+    try:
+        posts, has_more = await search_posts(brand, model, max_price, year_from, page)
+    except Exception as e:
+        logger.error(f"Error searching posts: {e}")
+        await update.message.reply_text(f'Помилка під час пошуку: {str(e)}')
+        return
+    
+    note = _search_car_note(brand, model, year_from)
+    if not posts:
+        await update.message.reply_text('\n\n'.join(filter(None, ['Нічого не знайдено.', note])))
+        return
+    
+    lines = [f'Результати пошуку (сторінка {page}):']
+    for number, post in enumerate(posts, (page - 1) * SEARCH_PAGE_SIZE + 1):
+        car_info = post.get('car_info') or {}
+        title = ' '.join(str(part) for part in (car_info.get('brand'), car_info.get('model'), car_info.get('year')) if part)
+        date = post['message_date'].strftime('%d.%m.%Y') if post.get('message_date') else ''
+        link = f"https://t.me/{str(post['source']).lstrip('@')}/{post['original_id']}"
+        lines.append(f"{number}. {title or 'Авто'} — ${post['price']} — {link} {date}".rstrip())
+    if has_more:
+        next_args = args[:4] + ['*'] * (4 - len(args[:4]))
+        lines.append(f"\nНаступна сторінка: /search {' '.join(next_args)} {page + 1}")
+    if note:
+        lines.append(f"\n{note}")
+    await update.message.reply_text('\n'.join(lines))
+
+SUBSCRIBE_USAGE = (
+    'Використання: /subscribe max=8000 min=3000 brand=opel model=astra year=2008 sources=@a,@b\n'
+    f'Усі параметри необов\'язкові; без max діє ліміт ${MAX_PRICE_USD:g}, max не більше ${SUBSCRIPTION_PRICE_CAP:g}.\n'
+    'brand, model і year працюють лише з аналізом оголошень (LIVE_GPT_ANALYSIS) і лише для нових постів.'
+)
+
+def _car_filter_keys(subscription):
+    """Return the filter keys that need car_info, which only the GPT analysis provides."""
+    return [key for key in ('brand', 'model', 'year_from') if subscription.get(key)]
+
+def _parse_subscription(args):
+    """Parse key=value /subscribe arguments into a filter document."""
+    subscription = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if not value:
+            raise ValueError(arg)
+        key = key.lower()
+        if key in ('max', 'max_price'):
+            subscription['max_price'] = float(value)
+        elif key in ('min', 'min_price'):
+            subscription['min_price'] = float(value)
+        elif key == 'brand':
+            subscription['brand'] = value
+        elif key == 'model':
+            subscription['model'] = value
+        elif key in ('year', 'year_from'):
+            subscription['year_from'] = int(value)
+        elif key == 'sources':
+            subscription['sources'] = [normalize_source(source) for source in value.split(',') if source]
+        else:
+            raise ValueError(arg)
+    
+    # Фільтр без верхньої межі отримує стандартний ліміт, а не нескінченність
+    subscription.setdefault('max_price', MAX_PRICE_USD)
+    if subscription['max_price'] > SUBSCRIPTION_PRICE_CAP:
+        raise ValueError('max')
+    if subscription.get('min_price', 0) > subscription['max_price']:
+        raise ValueError('min')
+    return subscription
+
+def _describe_subscription(subscription):
+    parts = []
+    if subscription.get('brand') or subscription.get('model'):
+        parts.append(' '.join(part for part in (subscription.get('brand'), subscription.get('model')) if part))
+    parts.append(f"${subscription.get('min_price') or 0:g}–{subscription['max_price']:g}")
+    if subscription.get('year_from'):
+        parts.append(f"від {subscription['year_from']} р.")
+    if subscription.get('sources'):
+        parts.append(', '.join(subscription['sources']))
+    return '; '.join(parts)
+
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Save a new filter for the current chat."""
+    logger.info(f"Subscribe command received from user {update.effective_user.id}: {context.args}")
+    try:
+        subscription = _parse_subscription(context.args or [])
+    except ValueError:
+        await update.message.reply_text(SUBSCRIBE_USAGE)
+        return
+    # Марку, модель і рік визначає лише GPT — без нього такий фільтр нічого б не отримав
+    car_keys = _car_filter_keys(subscription)
+    if car_keys and not LIVE_GPT_ANALYSIS:
+        await update.message.reply_text(
+            f"Фільтри за маркою, моделлю та роком ({', '.join(car_keys)}) недоступні: "
+            'аналіз оголошень (LIVE_GPT_ANALYSIS) вимкнено. Залиште лише ціну та джерела.'
+        )
+        return
+    
+    subscription.update({
+        'chat_id': update.effective_chat.id,
+        'created_at': datetime.utcnow(),
+        'created_by': update.effective_user.id,
+    })
+    try:
+        await mongo_client.car_bot.subscriptions.insert_one(subscription)
+        subscription_index.add(subscription)
+        logger.info(f"Added subscription {subscription['_id']} for chat {subscription['chat_id']}")
+        await update.message.reply_text(
+            f"Фільтр {subscription['_id']} збережено: {_describe_subscription(subscription)}"
+        )
+    except Exception as e:
+        logger.error(f"Error adding subscription: {e}")
+        await update.message.reply_text(f'Помилка при збереженні фільтра: {str(e)}')
+
+async def list_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List the current chat's filters."""
+    logger.info(f"Filters command received from user {update.effective_user.id}")
+    chat_id = update.effective_chat.id
+    subscriptions = [s for s in subscription_index.filters.values() if s['chat_id'] == chat_id]
+    if not subscriptions:
+        await update.message.reply_text('У цього чату немає фільтрів. Додайте через /subscribe.')
+        return
+    lines = ['Ваші фільтри:']
+    for subscription in subscriptions:
+        lines.append(f"- {subscription['_id']}: {_describe_subscription(subscription)}")
+    await update.message.reply_text('\n'.join(lines))
+
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Remove one of the current chat's filters, or all of them."""
+    logger.info(f"Unsubscribe command received from user {update.effective_user.id}: {context.args}")
+    if not context.args:
+        await update.message.reply_text('Будь ласка, вкажіть ID фільтра або all.')
+        return
+    
+    chat_id = update.effective_chat.id
+    target = context.args[0]
+    subscriptions = [
+        s for s in subscription_index.filters.values()
+        if s['chat_id'] == chat_id and (target == 'all' or str(s['_id']) == target)
+    ]
+    if not subscriptions:
+        await update.message.reply_text(f'Фільтр {target} не знайдено.')
+        return
+    try:
+        ids = [s['_id'] for s in subscriptions]
+        await mongo_client.car_bot.subscriptions.delete_many({'_id': {'$in': ids}})
+        for filter_id in ids:
+            subscription_index.remove(filter_id)
+        logger.info(f"Removed {len(ids)} subscriptions for chat {chat_id}")
+        await update.message.reply_text(f'Видалено фільтрів: {len(ids)}')
+    except Exception as e:
+        logger.error(f"Error removing subscription: {e}")
+        await update.message.reply_text(f'Помилка при видаленні фільтра: {str(e)}')
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send processing counters and per-step latency percentiles."""
+    logger.info(f"Stats command received from user {update.effective_user.id}")
+    lines = ['Статистика обробки:']
+    for outcome, value in sorted(metrics.counters.items()):
+        lines.append(f"- {outcome}: {value}")
+    
+    lines.append('\nЗатримки (p50 / p95, с):')
+    for step, histogram in sorted(metrics.histograms.items()):
+        lines.append(f"- {step}: {histogram.quantile(0.5)} / {histogram.quantile(0.95)} ({histogram.count})")
+    
+    lines.append('\nЧерги:')
+    for name, stage in ingest_pipeline.stats().items():
+        lines.append(f"- {name}: {stage['depth']}")
+    lines.append(f"- delivery: {delivery_queue.stats()['depth']}")
+    await update.message.reply_text('\n'.join(lines))
+
+async def check_historical_messages(source, hours=72, watermarks=None):
+    """Check new messages in the source channel since its high-water mark.
+
+    Sources without a stored watermark are scanned for the last `hours` hours.
+    `watermarks` overrides the registry's marks (used for the post-restart catch-up).
+    """
+    highest_id = 0
+    client = user_pool.client_for(source)
+    try:
+        # Вхідний peer з кешу — без ResolveUsername на кожен прохід
+        peer = await entity_cache.resolve(source)
+        watermark = (source_registry.watermarks if watermarks is None else watermarks).get(source)
+        if watermark:
+            logger.info(f"Checking historical messages from {source} after message {watermark}")
+            messages = client.iter_messages(peer, min_id=watermark, reverse=True)
+        else:
+            logger.info(f"Checking historical messages from {source} for the last {hours} hours")
+            
+            # Get the timestamp from 72 hours ago
+            time_threshold = datetime.now() - timedelta(hours=hours)
+            messages = client.iter_messages(peer, offset_date=time_threshold, reverse=True)
         
         # Get messages from the channel
         message_count = 0
-        async for message in user_client.iter_messages(source, offset_date=time_threshold, reverse=True):
+        async for message in messages:
             message_count += 1
+            highest_id = max(highest_id, message.id)
+            metrics.inc('historical_scanned')
             if message.text:  # Check only text messages
                 logger.info(f"Processing message: {message.text}")
-                message_text = message.text.lower()
-                
-                # Розширена перевірка на наявність цінових маркерів
-                price_markers = ['$', 'usd', 'дол', 'dollar']
-                if any(marker in message_text for marker in price_markers):
-                    price = extract_price(message_text)
-                    logger.info(f"Found message with potential price. Text: {message_text}, Extracted price: {price}")
+                # Один прохід скомпільованим виразом замість попереднього пошуку маркерів
+                price = extract_price(message.text)
+                if price is not None:
+                    logger.info(f"Found message with potential price. Extracted price: {price}")
                     
-                    if price and price <= 10000:
+                    if price <= subscription_index.price_ceiling():
                         logger.info(f"Price {price} is within range")
-                        db = mongo_client.car_bot
-                        
-                        # Check if we already have this message
-                        existing_post = await db.posts.find_one({
+                        post_data = {
+                            'text': message.text,
                             'source': source,
-                            'original_id': message.id
-                        })
+                            'posted_at': datetime.utcnow(),
+                            'original_id': message.id,
+                            'price': price,
+                            'message_date': message.date
+                        }
                         
-                        if not existing_post:
-                            logger.info(f"New message found, preparing to forward")
-                            post_data = {
-                                'text': message.text,
-                                'source': source,
-                                'posted_at': datetime.utcnow(),
-                                'original_id': message.id,
-                                'price': price,
-                                'message_date': message.date
-                            }
-                            await db.posts.insert_one(post_data)
-                            
-                            target_chat_id = os.getenv('TARGET_CHAT_ID')
-                            logger.info(f"Sending to target chat: {target_chat_id}")
-                            
-                            source_link = f"https://t.me/{source.replace('@', '')}/{message.id}"
-                            forward_text = f"🚗 Нова пропозиція: ${price}\n\nДжерело: {source_link}"
-                            
-                            try:
-                                await bot_client.send_message(target_chat_id, forward_text)
-                                logger.info(f"Successfully forwarded message with price ${price} from {source}")
-                            except Exception as send_error:
-                                logger.error(f"Error sending message to target chat: {send_error}")
-                            
-                            # Add small delay to avoid flooding
-                            await asyncio.sleep(1)
-                        else:
-                            logger.info(f"Message already exists in database")
+                        # Пересилаємо лише нові пости — після запису пакета; копії з інших каналів
+                        # отримають лише ті підписники, яким оригінал не надсилали
+                        if mark_near_duplicate(post_data):
+                            logger.info(f"Near-duplicate of {post_data['duplicate_of']}")
+                        await post_writer.add(post_data, on_inserted=forward_historical_posts)
                     else:
-                        logger.info(f"Price {price} is not within range or is None")
+                        logger.info(f"Price {price} is not within range")
         
         logger.info(f"Finished checking historical messages from {source}. Processed {message_count} messages")
+        return message_count
+    except errors.FloodWaitError:
+        # FloodWait обробляє планувальник, щоб призупинити весь дата-центр
+        raise
     except Exception as e:
         logger.error(f"Error checking historical messages from {source}: {e}")
+        # Застарілий запис кешу не має ламати наступні проходи
+        entity_cache.discard(user_pool.session_for(source)[0], source)
+        return 0
+    finally:
+        # Навіть після FloodWait наступний прохід продовжить з місця зупинки — але лише
+        # після запису буфера, інакше пости з нього після збою опиняться за водяним знаком
+        if highest_id:
+            if await post_writer.flush():
+                await source_registry.advance_watermark(source, highest_id)
+                live_watermarks.covered(source, highest_id)
+            else:
+                logger.warning(f"Posts from {source} were not written, keeping its watermark")
+
+def _forward_text(post):
+    source_link = f"https://t.me/{post['source'].replace('@', '')}/{post['original_id']}"
+    return f"🚗 Нова пропозиція: ${post['price']}\n\nДжерело: {source_link}"
+
+async def forward_historical_posts(posts):
+    """Index newly stored historical posts and forward them to matching subscribers."""
+    for post in posts:
+        if 'simhash' in post and 'duplicate_of' not in post:
+            # Копії з того самого пакета ще не були в індексі, коли їх позначали
+            original = near_duplicates.find(
+                post['simhash'] & _SIMHASH_MASK, post.get('price'), post['source'], post['original_id']
+            )
+            if original is not None:
+                post['duplicate_of'] = {'source': original[0], 'original_id': original[1]}
+        index_near_duplicate(post)
+    # Черга доставки сама дотримується лімітів — сканування не чекає на відправку
+    results = await deliver_batch([(_forward_text(post), post) for post in posts])
+    logger.info(f"{len(posts)} new messages found, queued {sum(map(len, results))} forwards")
+
+# FloodWait діє на весь дата-центр акаунта: (сесія, dc_id) -> момент (monotonic), до якого чекаємо
+flood_wait_until = {}
+# Прогрес історичного сканування по джерелах
+backfill_stats = {}
+metrics.add_collector('backfill', lambda: {'sources': backfill_stats}, label='source')
+
+async def _wait_for_flood(flood_key):
+    delay = flood_wait_until.get(flood_key, 0) - time.monotonic()
+    if delay > 0:
+        logger.info(f"Waiting {delay:.0f}s for FloodWait on session {flood_key[0]}, DC {flood_key[1]}")
+        await asyncio.sleep(delay)
+
+async def backfill_source(source, hours, semaphore, watermarks=None):
+    """Check one source's history under its session's semaphore, retrying after FloodWait."""
+    # Ліміти рахуються на акаунт, тож FloodWait однієї сесії не зупиняє інші
+    session, client = user_pool.session_for(source)
+    flood_key = (session, client.session.dc_id)
+    for attempt in range(BACKFILL_MAX_RETRIES + 1):
+        async with semaphore:
+            await _wait_for_flood(flood_key)
+            started = time.monotonic()
+            try:
+                scanned = await check_historical_messages(source, hours=hours, watermarks=watermarks)
+            except errors.FloodWaitError as e:
+                flood_wait_until[flood_key] = max(flood_wait_until.get(flood_key, 0), time.monotonic() + e.seconds)
+                logger.warning(f"FloodWait of {e.seconds}s on session {flood_key[0]}, DC {flood_key[1]} while scanning {source} (attempt {attempt + 1})")
+                continue
+        elapsed = time.monotonic() - started
+        backfill_stats[source] = {
+            'messages': scanned,
+            'seconds': round(elapsed, 2),
+            'messages_per_sec': round(scanned / elapsed, 1) if elapsed > 0 else 0.0,
+            'finished_at': datetime.utcnow(),
+        }
+        logger.info(f"Backfill {source}: {scanned} messages in {elapsed:.1f}s ({backfill_stats[source]['messages_per_sec']} msg/s)")
+        return
+    logger.error(f"Giving up on backfill of {source} after {BACKFILL_MAX_RETRIES + 1} attempts")
+
+async def run_backfill(sources, hours=6, watermarks=None):
+    """Check historical messages for several sources concurrently, BACKFILL_CONCURRENCY per session."""
+    semaphores = {}
+    started = time.monotonic()
+    await asyncio.gather(*(
+        backfill_source(source, hours, semaphores.setdefault(user_pool.session_for(source)[0], asyncio.Semaphore(BACKFILL_CONCURRENCY)), watermarks)
+        for source in sources
+    ))
+    elapsed = time.monotonic() - started
+    scanned = sum(backfill_stats.get(source, {}).get('messages', 0) for source in sources)
+    logger.info(f"Backfill of {len(sources)} sources finished in {elapsed:.1f}s, {scanned} messages scanned")
 
 async def add_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add a new source to monitor."""
@@ -219,7 +2442,7 @@ async def add_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Перевірка чи існує канал
         try:
-            channel = await user_client.get_entity(source)
+            channel = await entity_cache.resolve(source)
             logger.info(f"Successfully found channel: {source}")
             
             # Додаємо канал до бази даних одразу
@@ -232,11 +2455,17 @@ async def add_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             # Add new source
+            chat_id = telethon_utils.get_peer_id(channel)
             await db.sources.insert_one({
                 'username': source,
+                'chat_id': chat_id,
+                'session': user_pool.owner(source),
                 'added_at': datetime.utcnow(),
                 'added_by': update.effective_user.id
             })
+            # Нові повідомлення приходять лише учасникам каналу — вступаємо з акаунта, що його читатиме
+            await join_channels(user_pool.client_for(source), [source])
+            source_registry.add(source, chat_id)
             logger.info(f"Successfully added source: {source}")
             await update.message.reply_text(f'Джерело {source} успішно додано до списку моніторингу.')
                 
@@ -290,6 +2519,7 @@ async def remove_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         db = mongo_client.car_bot
         result = await db.sources.delete_one({'username': source})
+        source_registry.remove(source)
         if result.deleted_count:
             logger.info(f"Successfully removed source: {source}")
             await update.message.reply_text(f'Джерело {source} успішно видалено.')
@@ -304,7 +2534,8 @@ async def get_monitored_sources():
     """Get list of monitored sources from database."""
     try:
         db = mongo_client.car_bot
-        sources = await db.sources.find().to_list(length=None)
+        with metrics.timed('get_monitored_sources'):
+            sources = await db.sources.find().to_list(length=None)
         source_list = [source['username'] for source in sources]
         logger.info(f"Retrieved {len(source_list)} monitored sources")
         return source_list
@@ -322,28 +2553,220 @@ async def join_channels(client, sources):
         except Exception as e:
             logger.error(f"Failed to join channel {source}: {e}")
 
+_URL_RE = re.compile(r'https?://\S+|t\.me/\S+|[@#]\w+')
+_NON_WORD_RE = re.compile(r'[^\w$€₴]+')
+
+def normalize_listing_text(text):
+    """Normalise a listing for cache keys: lower case, no links/mentions/hashtags, emoji or punctuation."""
+    text = _URL_RE.sub(' ', (text or '').lower())
+    return ' '.join(_NON_WORD_RE.sub(' ', text).split())
+
+class AnalysisCache:
+    """Cache of GPT analysis results keyed by a hash of the normalised message text.
+
+    An in-memory LRU sits in front of the analysis_cache collection, whose
+    documents expire through a TTL index on created_at.
+    """
+
+    def __init__(self, max_size=ANALYSIS_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(normalize_listing_text(text).encode('utf-8')).hexdigest()
+
+    def _remember(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            return self._entries[key]
+        try:
+            with metrics.timed('mongo_find_cache'):
+                doc = await mongo_client.car_bot.analysis_cache.find_one({'_id': key}, {'result': 1})
+        except Exception as e:
+            logger.error(f"Error reading analysis cache: {e}")
+            doc = None
+        if doc is not None:
+            self.mongo_hits += 1
+            self._remember(key, doc['result'])
+            return doc['result']
+        self.misses += 1
+        return None
+
+    async def put(self, key, result):
+        self._remember(key, result)
+        try:
+            await mongo_client.car_bot.analysis_cache.replace_one(
+                {'_id': key}, {'_id': key, 'result': result, 'created_at': datetime.utcnow()}, upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error writing analysis cache: {e}")
+
+    def stats(self):
+        hits = self.memory_hits + self.mongo_hits
+        lookups = hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'mongo_hits': self.mongo_hits,
+            'misses': self.misses,
+            'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+            'api_calls_saved': hits,
+        }
+
+analysis_cache = AnalysisCache()
+metrics.add_collector('analysis_cache', analysis_cache.stats)
+
 async def analyze_message_with_gpt(text):
-    """Analyze message text with GPT to extract price and determine if it's a car sale post."""
-    try:
-        prompt = f"""Проаналізуй це повідомлення з Telegram каналу:
-        
-        {text}
-        
-        Дай відповідь в форматі JSON:
-        {{
+    """Analyze message text with GPT, reusing cached results for identical listings."""
+    with metrics.timed('analyze_message_with_gpt'):
+        return await _analyze_message_with_gpt(text)
+
+async def _analyze_message_with_gpt(text):
+    key = AnalysisCache.key(text)
+    cached = await analysis_cache.get(key)
+    if cached is not None:
+        logger.info(f"GPT analysis cache hit: {cached}")
+        return cached
+    
+    result = await analysis_batcher.submit(text)
+    if result is not None:
+        await analysis_cache.put(key, result)
+    return result
+
+ANALYSIS_ITEM_SCHEMA = """{
+            "index": number,  // номер повідомлення, до якого належить результат
             "is_car_sale": true/false,  // чи це оголошення про продаж авто
             "price_usd": number or null,  // ціна в USD (null якщо не знайдено)
-            "car_info": {{  // інформація про авто (null якщо не знайдено)
+            "car_info": {  // інформація про авто (null якщо не знайдено)
                 "brand": string,  // марка
                 "model": string,  // модель
                 "year": number or null,  // рік випуску
                 "condition": string  // стан авто
-            }}
-        }}
+            }
+        }"""
+
+# Помилки OpenAI, після яких має сенс повторити запит
+RETRYABLE_GPT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, asyncio.TimeoutError)
+
+class AnalysisBatcher:
+    """Coalesce GPT analysis requests into batched calls.
+
+    Texts submitted within `window` seconds of each other (up to `batch_size`)
+    go out as one request that returns a JSON array of results. At most
+    `max_in_flight` requests run at once; retryable errors are retried with
+    exponential backoff and jitter while the batch stays within its retry
+    budget. Set OPENAI_BASE_URL to point the client at a local stub server.
+    """
+
+    def __init__(self, batch_size=ANALYSIS_BATCH_SIZE, window=ANALYSIS_BATCH_WINDOW,
+                 max_in_flight=ANALYSIS_MAX_IN_FLIGHT):
+        self.batch_size = batch_size
+        self.window = window
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._dispatcher = None
+        self.requests = 0
+        self.items = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def submit(self, text):
+        """Queue a text for analysis and wait for its result (None on failure)."""
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._semaphore.acquire()
+            asyncio.create_task(self._process(batch))
+
+    async def _process(self, batch):
+        self.requests += 1
+        self.items += len(batch)
+        try:
+            results = await self._request_with_retries([text for text, _ in batch])
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error analyzing {len(batch)} messages with GPT: {e}")
+            results = [None] * len(batch)
+        finally:
+            self._semaphore.release()
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _request_with_retries(self, texts):
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.wait_for(request_gpt_analysis(texts), ANALYSIS_TIMEOUT)
+            except RETRYABLE_GPT_ERRORS as e:
+                delay = ANALYSIS_BACKOFF_BASE * 2 ** attempt + random.uniform(0, ANALYSIS_BACKOFF_BASE)
+                attempt += 1
+                if attempt > ANALYSIS_MAX_RETRIES or time.monotonic() - started + delay > ANALYSIS_RETRY_BUDGET:
+                    raise
+                self.retries += 1
+                logger.warning(f"GPT request failed ({type(e).__name__}), retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'items': self.items,
+            'avg_batch_size': round(self.items / self.requests, 2) if self.requests else 0.0,
+            'retries': self.retries,
+            'failures': self.failures,
+            'queued': self._queue.qsize(),
+        }
+
+analysis_batcher = AnalysisBatcher()
+metrics.add_collector('analysis_batcher', analysis_batcher.stats)
+
+async def request_gpt_analysis(texts):
+    """Analyze a batch of message texts with GPT in a single request.
+
+    Returns a list with one result (or None) per text, in the same order.
+    Results are matched to texts by their "index"; a response that cannot be
+    matched reliably yields None for every text rather than shifted results.
+    """
+    messages_text = "\n\n".join(f"Повідомлення {i}:\n{text}" for i, text in enumerate(texts, 1))
+    prompt = f"""Проаналізуй ці повідомлення з Telegram каналів ({len(texts)} шт.):
+        
+        {messages_text}
+        
+        Дай відповідь у форматі JSON-масиву з {len(texts)} елементів у тому ж порядку, кожен елемент:
+        {ANALYSIS_ITEM_SCHEMA}
         
         Відповідай ТІЛЬКИ в форматі JSON, без додаткових коментарів."""
 
-        response = await openai_client.chat.completions.create(
+    # Повтори й тайм-аут керує AnalysisBatcher, тому вбудовані повтори клієнта вимикаємо
+    with metrics.timed('gpt_request'):
+        response = await get_openai_client().with_options(max_retries=0, timeout=ANALYSIS_TIMEOUT).chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "Ти асистент, який аналізує оголошення про продаж авто. Відповідай строго в форматі JSON."},
@@ -351,68 +2774,152 @@ async def analyze_message_with_gpt(text):
             ],
             temperature=0
         )
-        
-        result = json.loads(response.choices[0].message.content)
-        logger.info(f"GPT analysis result: {result}")
-        return result
-    except Exception as e:
-        logger.error(f"Error analyzing message with GPT: {e}")
-        return None
+    
+    results = json.loads(response.choices[0].message.content)
+    if isinstance(results, dict):
+        # Модель іноді загортає масив в об'єкт або повертає один об'єкт на одне повідомлення
+        results = results.get('results', [results])
+    results = _match_gpt_results(results, len(texts))
+    logger.info(f"GPT analysis results: {results}")
+    return results
+
+def _match_gpt_results(results, count):
+    """Place GPT results at the positions of their messages, or return all None if that is ambiguous."""
+    if not isinstance(results, list) or not all(isinstance(result, dict) for result in results):
+        logger.warning(f"GPT returned malformed results for {count} messages")
+        return [None] * count
+    indices = [result.pop('index', None) for result in results]
+    if all(isinstance(index, int) and 1 <= index <= count for index in indices) and len(set(indices)) == len(indices):
+        matched = [None] * count
+        for index, result in zip(indices, results):
+            matched[index - 1] = result
+        return matched
+    if len(results) == count and all(index is None for index in indices):
+        return results
+    # Зсунутий результат потрапив би до кешу під чужим текстом — краще не мати жодного
+    logger.warning(f"GPT returned {len(results)} results for {count} messages without usable indices, discarding the batch")
+    return [None] * count
+
+# Слова, що натякають на ціну, яку не розпізнав extract_prices — такі тексти віддаємо GPT
+PRICE_MARKERS_RE = re.compile(r'\$|usd|дол|dollar|ціна|цена|price|грн|uah|€|eur|євро|торг', re.IGNORECASE)
+
+def prefilter_message(text):
+    """Cheap local tier before the LLM.
+
+    Returns a (decision, reason) tuple where decision is 'reject' for obvious
+    non-listings and over-limit prices, or 'escalate' for texts the LLM should see.
+    """
+    if not text or not text.strip():
+        return 'reject', 'empty'
+    
+    prices = [to_usd(amount, currency) for amount, currency in extract_prices(text)]
+    prices = [price for price in prices if price is not None]
+    if prices:
+        if min(prices) > subscription_index.price_ceiling():
+            return 'reject', 'over_limit'
+        return 'escalate', 'price_in_range'
+    
+    if PRICE_MARKERS_RE.search(text):
+        return 'escalate', 'ambiguous_price'
+    return 'reject', 'no_price'
+
+class ClassifierStats:
+    """Counters for the tiered classifier."""
+
+    def __init__(self):
+        self.decisions = {}  # (decision, reason) -> count
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.prefilter_seconds = 0.0
+
+    def record(self, decision, reason, prefilter_seconds):
+        key = (decision, reason)
+        self.decisions[key] = self.decisions.get(key, 0) + 1
+        self.prefilter_seconds += prefilter_seconds
+
+    def stats(self):
+        total = sum(self.decisions.values())
+        rejected = sum(count for (decision, _), count in self.decisions.items() if decision == 'reject')
+        avg_llm = self.llm_seconds / self.llm_calls if self.llm_calls else 0.0
+        return {
+            'messages': total,
+            'decisions': {f'{decision}:{reason}': count for (decision, reason), count in self.decisions.items()},
+            'llm_calls': self.llm_calls,
+            'llm_avoided_fraction': round(rejected / total, 3) if total else 0.0,
+            'avg_llm_latency': round(avg_llm, 3),
+            'avg_prefilter_latency': round(self.prefilter_seconds / total, 6) if total else 0.0,
+            # Скільки часу на повідомлення зекономили відхилення без GPT
+            'latency_saved_per_message': round(rejected * avg_llm / total, 3) if total else 0.0,
+        }
+
+classifier_stats = ClassifierStats()
+metrics.add_collector('classifier', classifier_stats.stats, label='decision')
+
+async def classify_message(text):
+    """Run the local prefilter and escalate only ambiguous texts to the LLM.
+
+    Returns the analysis dict, or None if the LLM analysis failed.
+    """
+    started = time.perf_counter()
+    decision, reason = prefilter_message(text)
+    classifier_stats.record(decision, reason, time.perf_counter() - started)
+    if decision == 'reject':
+        logger.info(f"Prefilter rejected message ({reason})")
+        return {'is_car_sale': False, 'price_usd': None, 'car_info': None}
+    
+    started = time.perf_counter()
+    analysis = await analyze_message_with_gpt(text)
+    classifier_stats.llm_calls += 1
+    classifier_stats.llm_seconds += time.perf_counter() - started
+    return analysis
 
 async def handle_new_message(event):
     try:
-        chat = await event.get_chat()
+        with metrics.timed('get_chat'):
+            chat = await event.get_chat()
         logger.info(f"Processing message from {chat.username or chat.id}")
         logger.info(f"Message text: {event.message.text}")
         
-        # Аналізуємо повідомлення за допомогою GPT
-        analysis = await analyze_message_with_gpt(event.message.text)
+        # Спершу дешевий локальний фільтр, GPT — лише для неоднозначних текстів
+        analysis = await classify_message(event.message.text)
         
         if analysis and analysis.get('is_car_sale'):
             price = analysis.get('price_usd')
             car_info = analysis.get('car_info')
             
-            if price and price <= 10000:
+            if price and price <= subscription_index.price_ceiling():
                 logger.info(f"Found valid car sale post with price: ${price}")
-                db = mongo_client.car_bot
-                
-                # Check if we already have this message
-                existing_post = await db.posts.find_one({
-                    'source': chat.username or str(chat.id),
-                    'original_id': event.message.id
-                })
+                post_data = {
+                    'text': event.message.text,
+                    'source': chat.username or chat.id,
+                    'posted_at': datetime.utcnow(),
+                    'original_id': event.message.id,
+                    'price': price,
+                    'message_date': event.message.date,
+                    'car_info': car_info
+                }
+                if mark_near_duplicate(post_data):
+                    logger.info(f"Near-duplicate of {post_data['duplicate_of']}")
                 
-                if not existing_post:
-                    post_data = {
-                        'text': event.message.text,
-                        'source': chat.username or str(chat.id),
-                        'posted_at': datetime.utcnow(),
-                        'original_id': event.message.id,
-                        'price': price,
-                        'car_info': car_info
-                    }
-                    await db.posts.insert_one(post_data)
+                if not await save_post(post_data):
+                    logger.info(f"Message already exists in database")
+                else:
                     logger.info(f"Saved message to database")
-                    
-                    target_chat_id = os.getenv('TARGET_CHAT_ID')
-                    logger.info(f"Attempting to forward to {target_chat_id}")
+                    index_near_duplicate(post_data)
                     
                     source_link = f"https://t.me/{chat.username}/{event.message.id}"
-                    car_info_text = f"\nАвто: {car_info['brand']} {car_info['model']}"
-                    if car_info.get('year'):
-                        car_info_text += f"\nРік: {car_info['year']}"
-                    if car_info.get('condition'):
-                        car_info_text += f"\nСтан: {car_info['condition']}"
+                    car_info_text = ''
+                    if car_info:
+                        car_info_text = f"\nАвто: {car_info.get('brand')} {car_info.get('model')}"
+                        if car_info.get('year'):
+                            car_info_text += f"\nРік: {car_info['year']}"
+                        if car_info.get('condition'):
+                            car_info_text += f"\nСтан: {car_info['condition']}"
                     
                     forward_text = f"{event.message.text}\n\nДжерело: {source_link}\nЗнайдена ціна: ${price}{car_info_text}"
                     
-                    try:
-                        await bot_client.send_message(target_chat_id, forward_text)
-                        logger.info(f"Successfully forwarded message to {target_chat_id}")
-                    except Exception as send_error:
-                        logger.error(f"Error sending message to target chat: {send_error}")
-                else:
-                    logger.info(f"Message already exists in database")
+                    chat_ids = await deliver_to_subscribers(forward_text, post_data)
+                    logger.info(f"Attempting to forward to {chat_ids}")
             else:
                 logger.info(f"Price ${price} is above threshold or not found")
         else:
@@ -425,13 +2932,35 @@ async def main():
     global application, user_client, bot_client, mongo_client
     
     logger.info("Starting bot...")
+    startup_timer.start()
+    metrics_server = None
     try:
-        # Initialize MongoDB
-        await init_mongodb()
+        # Незалежні підключення стартують паралельно: MongoDB, акаунти, бот, сервер метрик
+        metrics_server, *_ = await startup_timer.phase('connect', asyncio.gather(
+            startup_timer.phase('metrics_server', start_metrics_server()),
+            startup_timer.phase('mongodb', init_mongodb()),
+            startup_timer.phase('user_sessions', start_user_sessions()),
+            startup_timer.phase('bot_client', start_bot_client()),
+        ))
+        
+        # Стан з MongoDB читаємо одночасно, коли з'єднання вже є
+        await startup_timer.phase('load_state', asyncio.gather(
+            source_registry.refresh(),
+            delivery_queue.load_pending(),
+            subscription_index.load(),
+            entity_cache.load(),
+        ))
+        # Індекс дублікатів може бути великим — завантажуємо у фоні
+        asyncio.create_task(near_duplicates.load())
+        # Знімок водяних знаків до старту live-обробника: перший прохід надолужить рівно пропущене
+        startup_watermarks = dict(source_registry.watermarks)
+        
+        # Конвеєр має працювати до того, як обробник почне приймати події
+        ingest_pipeline.start()
         
-        # Setup both clients
-        await setup_clients()
+        await startup_timer.phase('attach_sessions', attach_user_sessions())
         logger.info("Both clients setup completed")
+        delivery_queue.start()
         
         # Create the Application for bot commands
         application = Application.builder().token(BOT_TOKEN).build()
@@ -443,6 +2972,11 @@ async def main():
         application.add_handler(CommandHandler("add_source", add_source))
         application.add_handler(CommandHandler("list_sources", list_sources))
         application.add_handler(CommandHandler("remove_source", remove_source))
+        application.add_handler(CommandHandler("search", search))
+        application.add_handler(CommandHandler("subscribe", subscribe))
+        application.add_handler(CommandHandler("filters", list_filters))
+        application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+        application.add_handler(CommandHandler("stats", stats_command))
         logger.info("Command handlers registered")
 
         # Run the bot
@@ -450,12 +2984,13 @@ async def main():
         
         # Start periodic historical messages check
         async def check_historical_periodically():
+            catch_up_watermarks = startup_watermarks
             while True:
                 try:
                     sources = await get_monitored_sources()
                     logger.info(f"Starting periodic historical check for sources: {sources}")
-                    for source in sources:
-                        await check_historical_messages(source, hours=6)
+                    await run_backfill(sources, hours=6, watermarks=catch_up_watermarks)
+                    catch_up_watermarks = None
                     logger.info("Periodic historical check completed")
                 except Exception as e:
                     logger.error(f"Error in periodic historical check: {e}")
@@ -463,13 +2998,17 @@ async def main():
         
         # Start both clients
         async with application:
-            await application.start()
+            await startup_timer.phase('bot_application', application.start())
             await application.updater.start_polling()
-            logger.info("Bot is running...")
+            logger.info(f"Bot is running, startup took {time.monotonic() - startup_timer.started:.2f}s: {startup_timer.phases}")
             
             # Start historical check in background
             asyncio.create_task(check_historical_periodically())
             
+            # Keep source registry in sync with the database
+            asyncio.create_task(source_registry.watch())
+            asyncio.create_task(resolve_sources_periodically())
+            
             # Keep the bot running
             while True:
                 await asyncio.sleep(1)
@@ -478,14 +3017,23 @@ async def main():
         logger.error(f"Error in main function: {e}")
     finally:
         # Cleanup
+        if mongo_client:
+            # Дописуємо конвеєр, буфер постів і чергу доставки, поки клієнти ще підключені
+            await album_coalescer.flush_all()
+            await ingest_pipeline.drain()
+            await live_watermarks.flush()
+            await post_writer.flush()
+            await delivery_queue.drain()
         if application:
             await application.stop()
-        if user_client:
-            await user_client.disconnect()
+        if user_pool.clients:
+            await user_pool.disconnect()
         if bot_client:
             await bot_client.disconnect()
         if mongo_client:
             mongo_client.close()
+        if metrics_server:
+            metrics_server.close()
 
 def run_bot():
     """Run the bot with proper async handling."""
@@ -496,29 +3044,113 @@ def run_bot():
     except Exception as e:
         logger.error(f"Bot crashed: {e}")
 
+_NUMBER = r'(?<![\d.,])(?:\d{1,3}(?:[ \u00a0.,]\d{3})+(?:[.,]\d{1,2})?(?![\d])|\d+(?:[.,]\d+)?)'
+_MULTIPLIER = r'(?:k|к|тис|тыс|tys)\.?(?!\w)'
+# "Euro 5" / "Євро-5" після року чи об'єму — екоклас двигуна, а не валюта
+_EURO_WORD = r'(?:euro|євро|евро)'
+_EMISSION_CLASS = r'[ \u00a0-]?[2-6](?!\d)'
+_CURRENCIES = {
+    'USD': r'\$|usd|у\.[ \u00a0]?о\.|дол\w*|dol\w*',
+    'EUR': rf'€|{_EURO_WORD}(?!{_EMISSION_CLASS})[^\W\d]*|eur(?!o)[^\W\d]*',
+    'UAH': r'₴|грн\.?|гривень|гривні|uah',
+}
+# Перед числом приймаємо лише символи та ISO-коди, щоб "доларів 2015" не ставало ціною
+_CURRENCIES_BEFORE = {
+    'USD': r'\$|usd',
+    'EUR': r'€|eur',
+    'UAH': r'₴|uah',
+}
+# Дешева перевірка до регулярного виразу: без жодної позначки валюти ціни в тексті немає.
+# Покриває всі варіанти з _CURRENCIES (у нижньому регістрі)
+_CURRENCY_MARKERS = ('$', '€', '₴', 'usd', 'eur', 'євро', 'евро', 'дол', 'dol', 'грн', 'гривень', 'гривні', 'uah',
+                     'у.о', 'у. о', 'у.\u00a0о')
+_CURRENCY = '|'.join(f'(?P<{code}>{pattern})' for code, pattern in _CURRENCIES.items())
+_CURRENCY_BEFORE = '|'.join(f'(?P<pre_{code}>{pattern})' for code, pattern in _CURRENCIES_BEFORE.items())
+
+# Пробіли всередині ціни — без переносу рядка, щоб рік на одному рядку не зливався з ціною на наступному
+_GAP = r'[ \t\u00a0]*'
+# Рік випуску між двома числами не забирає валюту собі: "2008 $4500" — це $4500, а не $2008,
+# тоді як у "15000$ 2012" символ належить числу перед ним
+_YEAR = r'(?:19[5-9]\d|20[0-4]\d)(?!\d)'
+_YEAR_BEFORE_PRICE = (
+    rf'(?!{_YEAR}{_GAP}(?:{"|".join(_CURRENCIES_BEFORE.values())}){_GAP}\d)'
+    # "2012 Euro" без цифри екокласу — теж рік і екоклас, а не 2012 EUR
+    rf'(?!{_YEAR}{_GAP}{_EURO_WORD})'
+)
+
+# Одна скомпільована альтернація: "$7 500", "7.500$", "7,5k usd", "180 тис. грн", "6500 євро"
+# Попередній lookahead відсікає позиції, з яких ціна почати не може
+PRICE_RE = re.compile(
+    rf'(?=[\d$€₴ue])(?:(?:{_CURRENCY_BEFORE}){_GAP}(?P<pre_num>{_NUMBER})(?:{_GAP}(?P<pre_mult>{_MULTIPLIER}))?'
+    rf'|{_YEAR_BEFORE_PRICE}(?P<num>{_NUMBER})(?:{_GAP}(?P<mult>{_MULTIPLIER}))?{_GAP}(?:{_CURRENCY}))',
+    re.IGNORECASE
+)
+_DECIMAL_TAIL_RE = re.compile(r'[.,](\d{1,2})$')
+
+def _parse_amount(number, multiplier):
+    """Turn a matched number with optional thousands separators and suffix into a float."""
+    tail = _DECIMAL_TAIL_RE.search(number)
+    if tail:
+        number, fraction = number[:tail.start()], tail.group(1)
+    else:
+        fraction = ''
+    digits = re.sub(r'\D', '', number)
+    amount = float(f"{digits}.{fraction}" if fraction else digits)
+    if multiplier:
+        amount *= 1000
+    return amount
+
+_PRE_CURRENCY_GROUPS = [(f'pre_{code}', code) for code in _CURRENCIES_BEFORE]
+_CURRENCY_GROUPS = [(code, code) for code in _CURRENCIES]
+
+def _iter_prices(text):
+    """Yield (amount, currency) for each price in the text, lazily and in order of appearance."""
+    for match in PRICE_RE.finditer(text):
+        number = match.group('pre_num')
+        if number is not None:
+            multiplier, currency_groups = match.group('pre_mult'), _PRE_CURRENCY_GROUPS
+        else:
+            number, multiplier, currency_groups = match.group('num'), match.group('mult'), _CURRENCY_GROUPS
+        try:
+            amount = _parse_amount(number, multiplier)
+        except ValueError:
+            continue
+        if amount > 0:
+            for group, code in currency_groups:
+                if match.group(group):
+                    yield amount, code
+                    break
+
+def extract_prices(text):
+    """Extract all prices from message text in a single pass.
+
+    Returns a list of (amount, currency) tuples in order of appearance.
+    """
+    return list(_iter_prices(text)) if text else []
+
+def to_usd(amount, currency):
+    """Convert an amount to USD using the local rate table, or None if the rate is unknown."""
+    rate = FX_RATES_TO_USD.get(currency)
+    if rate is None:
+        return None
+    return round(amount * rate, 2)
+
 def extract_price(text):
-    """Extract price from message text."""
+    """Extract the first plausible price (at least MIN_PRICE_USD) from message text, converted to USD."""
     if not text:
         return None
-        
-    # Шукаємо цифри з доларом
-    patterns = [
-        r'\$\s*(\d+(?:,\d{3})*(?:\.\d{2})?)',  # $1000 or $1,000 or $1000.00
-        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*\$',  # 1000$ or 1,000$ or 1000.00$
-        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*(?:USD|usd)',  # 1000USD or 1,000USD
-        r'(\d+(?:,\d{3})*(?:\.\d{2})?)\s*(?:дол|dol)',  # 1000дол or 1000dol
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            try:
-                # Видаляємо коми та конвертуємо в число
-                price_str = match.group(1).replace(',', '')
-                return float(price_str)
-            except ValueError:
-                continue
-                
+    # Більшість повідомлень у чатах без ціни: відсікаємо їх перевіркою підрядків
+    lowered = text.lower()
+    for marker in _CURRENCY_MARKERS:
+        if marker in lowered:
+            break
+    else:
+        return None
+    # Ледачий перебір: далі першої правдоподібної ціни текст не розбираємо
+    for amount, currency in _iter_prices(text):
+        price = to_usd(amount, currency)
+        if price is not None and price >= MIN_PRICE_USD:
+            return price
     return None
 
 if __name__ == '__main__':